@@ -24,13 +24,16 @@ USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 __version__ = '2.1.5'
 
+import bisect
+import collections
+import functools
+import hashlib
 import json
 import logging
 import pkg_resources
 import re
 
 from colors import color
-import jmespath
 
 cloudtrail_supported_actions = None
 
@@ -70,16 +73,145 @@ NO_IAM = {
     "signin:switchrole": True
 }
 
+@functools.lru_cache(maxsize=1024)
+def compile_action_glob(pattern):
+    """Compile an IAM action glob, where * and ? are wildcards, into a regex matcher"""
+    regex = re.escape(pattern).replace('\\*', '.*').replace('\\?', '.')
+    return re.compile('^' + regex + '$').match
+
+
+class ActionIndex(object):
+    """
+    Index of the known API calls, used to expand the action globs of IAM policies.
+    Actions are stored by their IAM name, bucketed by service and sorted, so that a glob
+    only has to look at the actions sharing its service and literal prefix.
+    """
+    actions = None
+    services = None
+
+    def __init__(self, aws_api_list):
+        self.actions = []
+        self.services = {}
+
+        # Convert the CloudTrail names to IAM names once, rather than per lookup
+        iam_names = {cloudtrail_name: iam_name for iam_name, cloudtrail_name in EVENT_RENAMES.items()}
+        for action in aws_api_list:
+            action = iam_names.get(action, action)
+            self.actions.append(action)
+            service, event = action.split(':', 1)
+            self.services.setdefault(service, []).append(event)
+
+        self.actions.sort()
+        for events in self.services.values():
+            events.sort()
+
+    def expand(self, pattern):
+        """Given an action glob from an IAM policy, such as s3:Get*, return the matching actions"""
+        pattern = pattern.lower()
+        if pattern in ('*', '*:*'):
+            return list(self.actions)
+
+        service, separator, event = pattern.partition(':')
+        if not separator or '*' in service or '?' in service:
+            # The service is globbed, so every action has to be checked
+            matcher = compile_action_glob(pattern)
+            return [action for action in self.actions if matcher(action)]
+
+        events = self.services.get(service)
+        if events is None:
+            return []
+
+        # Only the events starting with the literal prefix of the glob can match
+        prefix = re.split(r'[*?]', event, 1)[0]
+        start = bisect.bisect_left(events, prefix)
+        if prefix == event:
+            if start < len(events) and events[start] == event:
+                return [pattern]
+            return []
+
+        matcher = None
+        if event != prefix + '*':
+            matcher = compile_action_glob(event)
+
+        actions = []
+        for index in range(start, len(events)):
+            if not events[index].startswith(prefix):
+                break
+            if matcher is None or matcher(events[index]):
+                actions.append('{}:{}'.format(service, events[index]))
+        return actions
+
+
+class PolicyCache(object):
+    """
+    Bounded LRU cache of the actions allowed and denied by policy documents, so that
+    a policy attached to many actors is only expanded once.  A cache must only be used
+    with a single ActionIndex.
+    """
+    policies = None
+    max_size = None
+
+    def __init__(self, max_size=1024):
+        self.policies = collections.OrderedDict()
+        self.max_size = max_size
+
+    @staticmethod
+    def get_key(policy_document, policy_arn=None, version_id=None):
+        """Managed policies are identified by their version, inline ones by their content"""
+        if policy_arn is not None:
+            return ('managed', policy_arn, version_id)
+        content = json.dumps(policy_document, sort_keys=True).encode('utf-8')
+        return ('inline', hashlib.sha256(content).hexdigest())
+
+    def get(self, key):
+        """Return the (allowed, denied) action sets for a policy, or None if not cached"""
+        expanded = self.policies.get(key)
+        if expanded is not None:
+            self.policies.move_to_end(key)
+        return expanded
+
+    def put(self, key, expanded):
+        """Record the (allowed, denied) action sets of a policy, evicting the least recently used"""
+        self.policies[key] = expanded
+        self.policies.move_to_end(key)
+        while len(self.policies) > self.max_size:
+            self.policies.popitem(last=False)
+
+
 class Privileges(object):
     """Keep track of privileges an actor has been granted"""
     stmts = None
+    policies = None
     roles = None
     aws_api_list = None
+    policy_cache = None
 
-    def __init__(self, aws_api_list):
+    def __init__(self, aws_api_list, policy_cache=None):
         self.stmts = []
+        self.policies = []
         self.roles = []
+        if not isinstance(aws_api_list, ActionIndex):
+            aws_api_list = ActionIndex(aws_api_list)
         self.aws_api_list = aws_api_list
+        self.policy_cache = policy_cache
+
+    def add_policy(self, policy_document, policy_arn=None, version_id=None):
+        """Adds all the statements of an IAM policy, using the policy cache if there is one"""
+        key = None
+        expanded = None
+        if self.policy_cache is not None:
+            key = PolicyCache.get_key(policy_document, policy_arn, version_id)
+            expanded = self.policy_cache.get(key)
+
+        if expanded is None:
+            policy_privileges = Privileges(self.aws_api_list)
+            for stmt in make_list(policy_document.get('Statement', [])):
+                policy_privileges.add_stmt(stmt)
+            expanded = policy_privileges.expand_statements()
+            if key is not None:
+                self.policy_cache.put(key, expanded)
+
+        self.policies.append(expanded)
 
     def add_stmt(self, stmt):
         """Adds a statement from an IAM policy"""
@@ -93,46 +225,40 @@ class Privileges(object):
         actions = {}
 
         for action in make_list(stmt['Action']):
-            # Normalize it
-            action = action.lower()
-            # Convert it's globbing to a regex
-            action = '^' + action.replace('*', '.*') + '$'
-
-            for possible_action in self.aws_api_list:
-                for iam_name, cloudtrail_name in EVENT_RENAMES.items():
-                    if possible_action == cloudtrail_name:
-                        possible_action = iam_name
-                if re.match(action, possible_action):
-                    actions[possible_action] = True
+            for possible_action in self.aws_api_list.expand(action):
+                actions[possible_action] = True
 
         return actions
 
-    def determine_allowed(self):
-        """After statements have been added from IAM policiies, find all the allowed API calls"""
-        actions = {}
+    def expand_statements(self):
+        """
+        Return the actions allowed by the statements that have been added, and the actions
+        that are denied outright, i.e. for every resource and without conditions.
+        """
+        allowed = set()
+        denied = set()
 
-        # Look at alloweds first
         for stmt in self.stmts:
             if stmt['Effect'] == 'Allow':
-                stmt_actions = self.get_actions_from_statement(stmt)
-                for action in stmt_actions:
-                    if action not in actions:
-                        actions[action] = [stmt]
-                    else:
-                        actions[action].append(stmt)
-
-        # Look at denied
-        for stmt in self.stmts:
-            if (stmt['Effect'] == 'Deny' and
-                    '*' in make_list(stmt.get('Resource', None)) and
-                    stmt.get('Condition', None) is None):
+                allowed.update(self.get_actions_from_statement(stmt))
+            elif (stmt['Effect'] == 'Deny' and
+                  '*' in make_list(stmt.get('Resource', None)) and
+                  stmt.get('Condition', None) is None):
+                denied.update(self.get_actions_from_statement(stmt))
 
-                stmt_actions = self.get_actions_from_statement(stmt)
-                for action in stmt_actions:
-                    if action in actions:
-                        del actions[action]
+        return (frozenset(allowed), frozenset(denied))
 
-        return list(actions)
+    def determine_allowed(self):
+        """After statements have been added from IAM policiies, find all the allowed API calls"""
+        allowed, denied = self.expand_statements()
+        allowed = set(allowed)
+        denied = set(denied)
+
+        for policy_allowed, policy_denied in self.policies:
+            allowed.update(policy_allowed)
+            denied.update(policy_denied)
+
+        return list(allowed - denied)
 
 
 def make_list(obj):
@@ -157,19 +283,61 @@ def normalize_api_call(service, eventName):
     return "{}:{}".format(service, eventName)
 
 
+class AccountIAM(object):
+    """
+    The output of `aws iam get-account-authorization-details` for an account, indexed by
+    user name, role name, group name and policy ARN so that lookups don't scan the file.
+    """
+    users = None
+    roles = None
+    groups = None
+    policies = None
+
+    def __init__(self, account_iam):
+        self.users = {}
+        self.roles = {}
+        self.groups = {}
+        self.policies = {}
+
+        for user in account_iam.get('UserDetailList') or []:
+            self.users.setdefault(user['UserName'], user)
+        for role in account_iam.get('RoleDetailList') or []:
+            self.roles.setdefault(role['RoleName'], role)
+        for group in account_iam.get('GroupDetailList') or []:
+            self.groups.setdefault(group['GroupName'], group)
+
+        # Only the default version of a managed policy is in effect
+        for policy in account_iam.get('Policies') or []:
+            if policy['Arn'] in self.policies:
+                continue
+            self.policies[policy['Arn']] = None
+            for policy_version in policy.get('PolicyVersionList') or []:
+                if policy_version.get('IsDefaultVersion'):
+                    self.policies[policy['Arn']] = policy_version
+                    break
+
+
+def as_account_iam(account_iam):
+    """Accept either the raw IAM data of an account, or an AccountIAM built from it"""
+    if isinstance(account_iam, AccountIAM):
+        return account_iam
+    return AccountIAM(account_iam)
+
+
 def get_account_iam(account):
     """Given account data from the config file, open the IAM file for the account"""
-    return json.load(open(account['iam']))
+    with open(account['iam']) as f:
+        return AccountIAM(json.load(f))
 
 
 def get_allowed_users(account_iam):
     """Return all the users in an IAM file"""
-    return jmespath.search('UserDetailList[].UserName', account_iam)
+    return list(as_account_iam(account_iam).users)
 
 
 def get_allowed_roles(account_iam):
     """Return all the roles in an IAM file"""
-    return jmespath.search('RoleDetailList[].RoleName', account_iam)
+    return list(as_account_iam(account_iam).roles)
 
 
 def print_actor_diff(performed_actors, allowed_actors, use_color):
@@ -206,7 +374,7 @@ def print_actor_diff(performed_actors, allowed_actors, use_color):
 
 def get_user_iam(username, account_iam):
     """Given the IAM of an account, and a username, return the IAM data for the user"""
-    user_iam = jmespath.search('UserDetailList[] | [?UserName == `{}`] | [0]'.format(username), account_iam)
+    user_iam = as_account_iam(account_iam).users.get(username)
     if user_iam is None:
         exit("ERROR: Unknown user named {}".format(username))
     return user_iam
@@ -214,72 +382,68 @@ def get_user_iam(username, account_iam):
 
 def get_role_iam(rolename, account_iam):
     """Given the IAM of an account, and a role name, return the IAM data for the role"""
-    role_iam = jmespath.search('RoleDetailList[] | [?RoleName == `{}`] | [0]'.format(rolename), account_iam)
+    role_iam = as_account_iam(account_iam).roles.get(rolename)
     if role_iam is None:
         raise Exception("Unknown role named {}".format(rolename))
     return role_iam
 
 
-def get_user_allowed_actions(aws_api_list, user_iam, account_iam):
+def get_managed_policy_version(policy_arn, account_iam):
+    """Given the IAM of an account, return the default version of a managed policy"""
+    return as_account_iam(account_iam).policies.get(policy_arn)
+
+
+def add_managed_policies(privileges, attached_policies, account_iam):
+    """Add the privileges of the managed policies attached to an actor"""
+    for managed_policy in attached_policies:
+        policy_version = get_managed_policy_version(managed_policy['PolicyArn'], account_iam)
+        if policy_version is None:
+            continue
+        privileges.add_policy(policy_version['Document'], managed_policy['PolicyArn'],
+                              policy_version.get('VersionId'))
+
+
+def get_user_allowed_actions(aws_api_list, user_iam, account_iam, policy_cache=None):
     """Return the privileges granted to a user by IAM"""
     groups = user_iam['GroupList']
     managed_policies = user_iam['AttachedManagedPolicies']
+    account_iam = as_account_iam(account_iam)
 
-    privileges = Privileges(aws_api_list)
+    privileges = Privileges(aws_api_list, policy_cache)
 
     # Get permissions from groups
     for group in groups:
-        group_iam = jmespath.search('GroupDetailList[] | [?GroupName == `{}`] | [0]'.format(group), account_iam)
+        group_iam = account_iam.groups.get(group)
         if group_iam is None:
             continue
         # Get privileges from managed policies attached to the group
-        for managed_policy in group_iam['AttachedManagedPolicies']:
-            policy_filter = 'Policies[?Arn == `{}`].PolicyVersionList[?IsDefaultVersion == true] | [0][0].Document'
-            policy = jmespath.search(policy_filter.format(managed_policy['PolicyArn']), account_iam)
-            if policy is None:
-                continue
-            for stmt in make_list(policy['Statement']):
-                privileges.add_stmt(stmt)
+        add_managed_policies(privileges, group_iam['AttachedManagedPolicies'], account_iam)
 
         # Get privileges from in-line policies attached to the group
         for inline_policy in group_iam['GroupPolicyList']:
-            policy = inline_policy['PolicyDocument']
-            for stmt in make_list(policy['Statement']):
-                privileges.add_stmt(stmt)
+            privileges.add_policy(inline_policy['PolicyDocument'])
 
     # Get privileges from managed policies attached to the user
-    for managed_policy in managed_policies:
-        policy_filter = 'Policies[?Arn == `{}`].PolicyVersionList[?IsDefaultVersion == true] | [0][0].Document'
-        policy = jmespath.search(policy_filter.format(managed_policy['PolicyArn']), account_iam)
-        if policy is None:
-            continue
-        for stmt in make_list(policy['Statement']):
-            privileges.add_stmt(stmt)
+    add_managed_policies(privileges, managed_policies, account_iam)
 
     # Get privileges from inline policies attached to the user
-    for stmt in jmespath.search('UserPolicyList[].PolicyDocument.Statement', user_iam) or []:
-        privileges.add_stmt(stmt)
+    for inline_policy in user_iam.get('UserPolicyList', []):
+        privileges.add_policy(inline_policy['PolicyDocument'])
 
     return privileges.determine_allowed()
 
 
-def get_role_allowed_actions(aws_api_list, role_iam, account_iam):
+def get_role_allowed_actions(aws_api_list, role_iam, account_iam, policy_cache=None):
     """Return the privileges granted to a role by IAM"""
-    privileges = Privileges(aws_api_list)
+    account_iam = as_account_iam(account_iam)
+    privileges = Privileges(aws_api_list, policy_cache)
 
     # Get privileges from managed policies
-    for managed_policy in role_iam['AttachedManagedPolicies']:
-        policy_filter = 'Policies[?Arn == `{}`].PolicyVersionList[?IsDefaultVersion == true] | [0][0].Document'
-        policy = jmespath.search(policy_filter.format(managed_policy['PolicyArn']), account_iam)
-        if policy is None:
-            continue
-        for stmt in make_list(policy['Statement']):
-            privileges.add_stmt(stmt)
+    add_managed_policies(privileges, role_iam['AttachedManagedPolicies'], account_iam)
 
     # Get privileges from attached policies
     for policy in role_iam['RolePolicyList']:
-        for stmt in make_list(policy['PolicyDocument']['Statement']):
-            privileges.add_stmt(stmt)
+        privileges.add_policy(policy['PolicyDocument'])
 
     return privileges.determine_allowed()
 
@@ -415,13 +579,39 @@ def run(args, config, start, end):
                 "elasticsearch 6 support"
             )
         datasource = ElasticSearch(config['elasticsearch'], start, end)
+    elif 'files' in config:
+        logging.debug("Using local CloudTrail files")
+        if config['files'].get('event_cache'):
+            try:
+                from cloudtracker.datasources.parquet import ParquetEvents
+            except ImportError:
+                exit(
+                    "Event cache support not installed. Install with support via "
+                    "'pip install git+https://github.com/duo-labs/cloudtracker.git#egg=cloudtracker[parquet]'"
+                )
+            datasource = ParquetEvents(config['files'], account, start, end)
+        else:
+            from cloudtracker.datasources.files import LocalFiles
+            datasource = LocalFiles(config['files'], account, start, end)
     else:
         logging.debug("Using Athena")
+        from cloudtracker.cache import DEFAULT_CACHE_DIRECTORY
         from cloudtracker.datasources.athena import Athena
-        datasource = Athena(config['athena'], account, start, end, args)
+        cache_directory = (config.get('cache') or {}).get('directory', DEFAULT_CACHE_DIRECTORY)
+        datasource = Athena(config['athena'], account, start, end, args, cache_directory)
+
+    if 'cache' in config and args.use_cache:
+        from cloudtracker.cache import CachedDatasource, ResultCache, RollupStore, DEFAULT_CACHE_DIRECTORY
+        cache_config = config['cache'] or {}
+        cache = ResultCache(cache_config.get('directory', DEFAULT_CACHE_DIRECTORY))
+        rollup_store = None
+        if cache_config.get('rollups', False):
+            rollup_store = RollupStore(cache)
+        datasource = CachedDatasource(datasource, cache, account, start, end, rollup_store)
 
     # Read AWS actions
-    aws_api_list = read_aws_api_list()
+    aws_api_list = ActionIndex(read_aws_api_list())
+    policy_cache = PolicyCache()
 
     # Read cloudtrail_supported_events
     global cloudtrail_supported_actions
@@ -435,6 +625,11 @@ def run(args, config, start, end):
 
     account_iam = get_account_iam(account)
 
+    printfilter = {}
+    printfilter['show_unknown'] = args.show_unknown
+    printfilter['show_benign'] = args.show_benign
+    printfilter['show_used'] = args.show_used
+
     if args.list:
         actor_type = args.list
 
@@ -449,13 +644,52 @@ def run(args, config, start, end):
 
         print_actor_diff(performed_actors, allowed_actors, use_color)
 
+    elif args.all_users or args.all_roles:
+        if args.destrole or args.destaccount:
+            exit("ERROR: --destrole and --destaccount can not be used when auditing all users or roles")
+
+        # The IAM data, API lists and datasource are loaded once and shared by every actor
+        search_query = datasource.get_search_query()
+
+        # Datasources that can fetch the events of every principal at once are only queried once
+        performed_by_principal = None
+        if hasattr(datasource, 'get_performed_event_names_by_principals'):
+            performed_by_principal = datasource.get_performed_event_names_by_principals(search_query)
+
+        if args.all_users:
+            for username in sorted(get_allowed_users(account_iam)):
+                user_iam = get_user_iam(username, account_iam)
+                print("Getting info on {}, user created {}".format(username, user_iam['CreateDate']))
+
+                allowed_actions = get_user_allowed_actions(aws_api_list, user_iam, account_iam, policy_cache)
+                if performed_by_principal is not None:
+                    performed_actions = performed_by_principal.get(user_iam['Arn'], {})
+                else:
+                    performed_actions = datasource.get_performed_event_names_by_user(search_query, user_iam)
+                print_diff(performed_actions, allowed_actions, printfilter, use_color)
+
+        if args.all_roles:
+            for rolename in sorted(get_allowed_roles(account_iam)):
+                role_iam = get_role_iam(rolename, account_iam)
+                print("Getting info for role {}".format(rolename))
+
+                allowed_actions = get_role_allowed_actions(aws_api_list, role_iam, account_iam, policy_cache)
+                if performed_by_principal is not None:
+                    performed_actions = performed_by_principal.get(role_iam['Arn'], {})
+                else:
+                    performed_actions = datasource.get_performed_event_names_by_role(search_query, role_iam)
+                print_diff(performed_actions, allowed_actions, printfilter, use_color)
+
     else:
         if args.destaccount:
             destination_account = get_account(config['accounts'], args.destaccount)
         else:
             destination_account = account
 
-        destination_iam = get_account_iam(destination_account)
+        if destination_account is account:
+            destination_iam = account_iam
+        else:
+            destination_iam = get_account_iam(destination_account)
 
         search_query = datasource.get_search_query()
 
@@ -469,11 +703,11 @@ def run(args, config, start, end):
                 dest_role_iam = get_role_iam(args.destrole, destination_iam)
                 print("Getting info for AssumeRole into {}".format(args.destrole))
 
-                allowed_actions = get_role_allowed_actions(aws_api_list, dest_role_iam, destination_iam)
+                allowed_actions = get_role_allowed_actions(aws_api_list, dest_role_iam, destination_iam, policy_cache)
                 performed_actions = datasource.get_performed_event_names_by_user_in_role(
                     search_query, user_iam, dest_role_iam)
             else:
-                allowed_actions = get_user_allowed_actions(aws_api_list, user_iam, account_iam)
+                allowed_actions = get_user_allowed_actions(aws_api_list, user_iam, account_iam, policy_cache)
                 performed_actions = datasource.get_performed_event_names_by_user(
                     search_query, user_iam)
         elif args.role:
@@ -485,19 +719,14 @@ def run(args, config, start, end):
                 dest_role_iam = get_role_iam(args.destrole, destination_iam)
                 print("Getting info for AssumeRole into {}".format(args.destrole))
 
-                allowed_actions = get_role_allowed_actions(aws_api_list, dest_role_iam, destination_iam)
+                allowed_actions = get_role_allowed_actions(aws_api_list, dest_role_iam, destination_iam, policy_cache)
                 performed_actions = datasource.get_performed_event_names_by_role_in_role(
                     search_query, role_iam, dest_role_iam)
             else:
-                allowed_actions = get_role_allowed_actions(aws_api_list, role_iam, account_iam)
+                allowed_actions = get_role_allowed_actions(aws_api_list, role_iam, account_iam, policy_cache)
                 performed_actions = datasource.get_performed_event_names_by_role(
                     search_query, role_iam)
         else:
             exit("ERROR: Must specify a user or a role")
 
-        printfilter = {}
-        printfilter['show_unknown'] = args.show_unknown
-        printfilter['show_benign'] = args.show_benign
-        printfilter['show_used'] = args.show_used
-
         print_diff(performed_actions, allowed_actions, printfilter, use_color)
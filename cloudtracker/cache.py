@@ -0,0 +1,361 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+"""
+
+import concurrent.futures
+import copy
+import datetime
+import json
+import logging
+import os
+import sqlite3
+
+from dateutil.relativedelta import relativedelta
+
+DEFAULT_CACHE_DIRECTORY = '~/.cloudtracker'
+CACHE_FILE_NAME = 'cache.sqlite'
+
+# CloudTrail delivers logs within about 15 minutes, so anything from before yesterday is final
+DAYS_UNTIL_CLOSED = 1
+
+
+def month_windows(start, end):
+    """
+    Split the dates from start to end, such as 2018-01-21, into one window per month,
+    clipped to start and end. Returns a list of (start, end) date strings.
+    """
+    start = datetime.datetime.strptime(start, '%Y-%m-%d').date()
+    end = datetime.datetime.strptime(end, '%Y-%m-%d').date()
+
+    windows = []
+    window_start = start
+    while window_start <= end:
+        next_month = window_start.replace(day=1) + relativedelta(months=1)
+        window_end = min(end, next_month - datetime.timedelta(days=1))
+        windows.append((window_start.isoformat(), window_end.isoformat()))
+        window_start = next_month
+    return windows
+
+
+def is_whole_month(window_start, window_end):
+    """Return True if a window of month_windows covers all of its month, rather than being clipped"""
+    window_start = datetime.datetime.strptime(window_start, '%Y-%m-%d').date()
+    window_end = datetime.datetime.strptime(window_end, '%Y-%m-%d').date()
+    return window_start.day == 1 and (window_end + datetime.timedelta(days=1)).day == 1
+
+
+def is_closed(window_end, today=None):
+    """Return True if no more logs will be delivered for a window ending on window_end"""
+    if today is None:
+        today = datetime.date.today()
+    window_end = datetime.datetime.strptime(window_end, '%Y-%m-%d').date()
+    return window_end < today - datetime.timedelta(days=DAYS_UNTIL_CLOSED)
+
+
+class ResultCache(object):
+    """
+    SQLite cache of datasource results, by datasource, account, principal and month.
+    Only months that are closed are stored, so cached results never need to be refreshed.
+    """
+    connection = None
+
+    def __init__(self, directory=DEFAULT_CACHE_DIRECTORY):
+        directory = os.path.expanduser(directory)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, CACHE_FILE_NAME)
+        logging.info('Using cache: {}'.format(path))
+
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            'datasource TEXT, account TEXT, method TEXT, principal TEXT, start TEXT, end TEXT, value TEXT, '
+            'PRIMARY KEY (datasource, account, method, principal, start, end))')
+        self.connection.commit()
+
+    def get(self, datasource, account, method, principal, start, end):
+        """Return a cached result, or None if there isn't one"""
+        row = self.connection.execute(
+            'SELECT value FROM results '
+            'WHERE datasource = ? AND account = ? AND method = ? AND principal = ? AND start = ? AND end = ?',
+            (datasource, str(account), method, principal, start, end)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def put(self, datasource, account, method, principal, start, end, value):
+        """Store a result, which must be JSON serializable"""
+        self.connection.execute(
+            'INSERT OR REPLACE INTO results (datasource, account, method, principal, start, end, value) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (datasource, str(account), method, principal, start, end, json.dumps(value)))
+        self.connection.commit()
+
+
+class RollupStore(object):
+    """
+    Rollups of when and how often each principal performed each action, stored alongside the
+    ResultCache by datasource, account and month.  Only closed whole months are stored, and
+    a month is only ever stored whole, so a month is either fully covered or not at all.
+    """
+    connection = None
+
+    def __init__(self, cache):
+        self.connection = cache.connection
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS rollup_windows ('
+            'datasource TEXT, account TEXT, start TEXT, end TEXT, '
+            'PRIMARY KEY (datasource, account, start, end))')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS rollups ('
+            'datasource TEXT, account TEXT, start TEXT, end TEXT, principal TEXT, action TEXT, '
+            'first_seen TEXT, last_seen TEXT, count INTEGER, '
+            'PRIMARY KEY (datasource, account, principal, start, end, action))')
+        self.connection.commit()
+
+    def has_window(self, datasource, account, start, end):
+        """Return True if the rollups for a window have been stored"""
+        row = self.connection.execute(
+            'SELECT 1 FROM rollup_windows WHERE datasource = ? AND account = ? AND start = ? AND end = ?',
+            (datasource, str(account), start, end)).fetchone()
+        return row is not None
+
+    def put_window(self, datasource, account, start, end, rollups):
+        """Store the (principal, action, first seen, last seen, count) rollups of a window"""
+        with self.connection:
+            self.connection.execute(
+                'DELETE FROM rollups WHERE datasource = ? AND account = ? AND start = ? AND end = ?',
+                (datasource, str(account), start, end))
+            self.connection.executemany(
+                'INSERT INTO rollups '
+                '(datasource, account, start, end, principal, action, first_seen, last_seen, count) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                ((datasource, str(account), start, end) + tuple(rollup) for rollup in rollups))
+            self.connection.execute(
+                'INSERT OR REPLACE INTO rollup_windows (datasource, account, start, end) VALUES (?, ?, ?, ?)',
+                (datasource, str(account), start, end))
+
+    def get_rollups(self, datasource, account, windows, principal=None):
+        """
+        Return the stored rollups of the given windows merged together, as a list of
+        (principal, action, first seen, last seen, count), optionally for a single principal.
+        """
+        rollups = []
+        for start, end in windows:
+            query = ('SELECT principal, action, first_seen, last_seen, count FROM rollups '
+                     'WHERE datasource = ? AND account = ? AND start = ? AND end = ?')
+            params = [datasource, str(account), start, end]
+            if principal is not None:
+                query += ' AND principal = ?'
+                params.append(principal)
+            rollups.extend(self.connection.execute(query, params))
+        return merge_rollups(rollups)
+
+
+def merge_rollups_into(merged, rollups):
+    """
+    Merge (principal, action, first seen, last seen, count) rollups into merged, a dict of
+    (principal, action) to [first seen, last seen, count]
+    """
+    for principal, action, first_seen, last_seen, count in rollups:
+        rollup = merged.get((principal, action))
+        if rollup is None:
+            merged[(principal, action)] = [first_seen, last_seen, count]
+        else:
+            rollup[0] = min(rollup[0], first_seen)
+            rollup[1] = max(rollup[1], last_seen)
+            rollup[2] += count
+
+
+def merge_rollups(rollups):
+    """Merge (principal, action, first seen, last seen, count) rollups of the same principal and action"""
+    merged = {}
+    merge_rollups_into(merged, rollups)
+    return [(principal, action, first_seen, last_seen, count)
+            for (principal, action), (first_seen, last_seen, count) in merged.items()]
+
+
+class CachedDatasource(object):
+    """
+    Wraps a datasource so that the performed users, roles and events are fetched one month
+    at a time, and the whole months that are closed are answered from the ResultCache.
+    If a RollupStore is given and the datasource supports rollups, the events of users and roles
+    are instead answered from the rollups of every principal, so that one query per month
+    serves all of them.  Anything else is passed through to the wrapped datasource.
+    """
+    datasource = None
+    cache = None
+    rollup_store = None
+    account = None
+    start = None
+    end = None
+
+    def __init__(self, datasource, cache, account, start, end, rollup_store=None):
+        self.datasource = datasource
+        self.cache = cache
+        self.account = account['id']
+        self.start = start
+        self.end = end
+
+        if rollup_store is not None and hasattr(datasource, 'get_action_rollups'):
+            self.rollup_store = rollup_store
+
+    def __getattr__(self, name):
+        return getattr(self.datasource, name)
+
+    def is_cacheable(self, window_start, window_end):
+        """
+        Only whole months that are closed are stored, so that each month is stored once whatever
+        the date range. The months at the edges of the date range are usually only partly in it.
+        """
+        return is_whole_month(window_start, window_end) and is_closed(window_end)
+
+    def fetch_windows(self, windows, fetch):
+        """
+        Return the result of fetch(datasource) for each (start, end) window, in order. Datasources
+        that run queries concurrently, such as Athena, fetch up to max_concurrent_queries windows
+        at once, each with its own copy of the datasource restricted to its window.
+        """
+        def fetch_window(window):
+            logging.debug('Fetching from {} to {}'.format(*window))
+            datasource = copy.copy(self.datasource)
+            datasource.set_date_range(*window)
+            return fetch(datasource)
+
+        workers = min(len(windows), getattr(self.datasource, 'max_concurrent_queries', 1))
+        if workers > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                return list(executor.map(fetch_window, windows))
+
+        results = []
+        try:
+            for window_start, window_end in windows:
+                logging.debug('Fetching from {} to {}'.format(window_start, window_end))
+                self.datasource.set_date_range(window_start, window_end)
+                results.append(fetch(self.datasource))
+        finally:
+            self.datasource.set_date_range(self.start, self.end)
+        return results
+
+    def get_by_month(self, method, principal, fetch):
+        """
+        Return the results of fetch(datasource) for each month from start to end, using the
+        cache for the months that have already been fetched.
+        """
+        cache_name = self.datasource.get_cache_name()
+        windows = month_windows(self.start, self.end)
+
+        results = {}
+        for window_start, window_end in windows:
+            if self.is_cacheable(window_start, window_end):
+                value = self.cache.get(cache_name, self.account, method, principal, window_start, window_end)
+                if value is not None:
+                    results[(window_start, window_end)] = value
+
+        missing = [window for window in windows if window not in results]
+        for (window_start, window_end), value in zip(missing, self.fetch_windows(missing, fetch)):
+            if self.is_cacheable(window_start, window_end):
+                self.cache.put(cache_name, self.account, method, principal, window_start, window_end, value)
+            results[(window_start, window_end)] = value
+
+        return [results[window] for window in windows]
+
+    def get_names_by_month(self, method, principal, fetch):
+        """Cache a result that is a dict of names to True, such as users or events"""
+        names = {}
+        for value in self.get_by_month(method, principal, lambda datasource: list(fetch(datasource))):
+            names.update(dict.fromkeys(value, True))
+        return names
+
+    def get_performed_users(self):
+        return self.get_names_by_month(
+            'get_performed_users', '*',
+            lambda datasource: datasource.get_performed_users())
+
+    def get_performed_roles(self):
+        return self.get_names_by_month(
+            'get_performed_roles', '*',
+            lambda datasource: datasource.get_performed_roles())
+
+    def get_performed_event_names_by_user(self, _, user_iam):
+        if self.rollup_store is not None:
+            return self.get_rollup_event_names(user_iam)
+        return self.get_names_by_month(
+            'get_performed_event_names_by_user', user_iam['Arn'],
+            lambda datasource: datasource.get_performed_event_names_by_user(datasource.get_search_query(), user_iam))
+
+    def get_performed_event_names_by_role(self, _, role_iam):
+        if self.rollup_store is not None:
+            return self.get_rollup_event_names(role_iam)
+        return self.get_names_by_month(
+            'get_performed_event_names_by_role', role_iam['Arn'],
+            lambda datasource: datasource.get_performed_event_names_by_role(datasource.get_search_query(), role_iam))
+
+    def get_performed_event_names_by_principals(self, _):
+        """The events of every principal, from the rollups or cached as one result per month"""
+        principals = {}
+        if self.rollup_store is not None:
+            for principal, action, _, _, _ in self.get_action_rollups():
+                principals.setdefault(principal, {})[action] = True
+            return principals
+
+        def fetch(datasource):
+            principals = datasource.get_performed_event_names_by_principals(datasource.get_search_query())
+            return {arn: list(event_names) for arn, event_names in principals.items()}
+
+        for value in self.get_by_month('get_performed_event_names_by_principals', '*', fetch):
+            for arn, event_names in value.items():
+                principals.setdefault(arn, {}).update(dict.fromkeys(event_names, True))
+        return principals
+
+    def get_action_rollups(self, principal=None):
+        """
+        Return the rollups of the date range, optionally for a single principal. The rollups of
+        closed whole months are read from the RollupStore, or fetched and stored there if they
+        haven't been yet. The partial months at the edges of the date range are fetched each time.
+        """
+        cache_name = self.datasource.get_cache_name()
+        windows = month_windows(self.start, self.end)
+
+        stored_windows = [
+            (window_start, window_end) for window_start, window_end in windows
+            if self.is_cacheable(window_start, window_end) and
+            self.rollup_store.has_window(cache_name, self.account, window_start, window_end)]
+        missing = [window for window in windows if window not in stored_windows]
+
+        fetched = []
+        all_rollups = self.fetch_windows(
+            missing, lambda datasource: datasource.get_action_rollups(datasource.get_search_query()))
+        for (window_start, window_end), rollups in zip(missing, all_rollups):
+            if self.is_cacheable(window_start, window_end):
+                self.rollup_store.put_window(cache_name, self.account, window_start, window_end, rollups)
+                stored_windows.append((window_start, window_end))
+            else:
+                fetched.extend(rollup for rollup in rollups if principal is None or rollup[0] == principal)
+
+        stored = self.rollup_store.get_rollups(cache_name, self.account, stored_windows, principal)
+        return merge_rollups(stored + fetched)
+
+    def get_rollup_event_names(self, actor_iam):
+        """The events of a user or role, from the rollups"""
+        return {action: True for _, action, _, _, _ in self.get_action_rollups(actor_iam['Arn'])}
@@ -36,7 +36,7 @@ def main():
     now = datetime.datetime.now()
     parser = argparse.ArgumentParser()
 
-    # Add mutually exclusive arguments for --list, --user, and --role
+    # Add mutually exclusive arguments for --list, --user, --role, and the --all variants
     action_group = parser.add_mutually_exclusive_group(required=True)
     action_group.add_argument("--list",
                               help="List \'users\' or \'roles\' that have been active",
@@ -47,6 +47,15 @@ def main():
     action_group.add_argument("--role",
                               help="Role to investigate",
                               type=str)
+    action_group.add_argument("--all-users", dest='all_users',
+                              help="Investigate every user in the account",
+                              action='store_true')
+    action_group.add_argument("--all-roles", dest='all_roles',
+                              help="Investigate every role in the account",
+                              action='store_true')
+    action_group.add_argument("--all",
+                              help="Investigate every user and role in the account",
+                              action='store_true')
 
     parser.add_argument("--config",
                         help="Config file name (default: config.yaml)",
@@ -89,8 +98,14 @@ def main():
     parser.add_argument("--skip-setup", dest='skip_setup',
                         help="For Athena, don't create or test for the tables",
                         required=False, action='store_true', default=False)
+    parser.add_argument("--no-cache", dest='use_cache',
+                        help="Don't use or update the cache of results, if one is configured",
+                        required=False, action='store_false')
 
     args = parser.parse_args()
+    if args.all:
+        args.all_users = True
+        args.all_roles = True
 
     # Read config
     try:
@@ -23,14 +23,22 @@ USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 ---------------------------------------------------------------------------
 """
 
+import codecs
+import csv
+import hashlib
 import logging
 import boto3
+import random
+import threading
 import time
 import json
+import os
 import datetime
+from botocore.exceptions import ClientError
 from dateutil.relativedelta import relativedelta
 
 from cloudtracker import normalize_api_call
+from cloudtracker.cache import DEFAULT_CACHE_DIRECTORY, is_closed, is_whole_month, merge_rollups, month_windows
 
 # Much thanks to Alex Smolen (https://twitter.com/alsmola)
 # for his post "Partitioning CloudTrail Logs in Athena"
@@ -43,40 +51,290 @@ from cloudtracker import normalize_api_call
 
 NUM_MONTHS_FOR_PARTITIONS = 12
 
+# Range of years projected when partition projection is used, from the year CloudTrail launched
+PROJECTION_YEAR_RANGE = '2013,2099'
+
+# File, in the cache directory, that remembers the regions found to have logs
+REGION_CACHE_FILE_NAME = 'regions.json'
+
+# How long the regions found to have logs are remembered, in seconds
+REGION_CACHE_SECONDS = 24 * 60 * 60
+
+# File, in the cache directory, that remembers the queries whose results can be reused
+QUERY_INDEX_FILE_NAME = 'queries.json'
+
+# Athena only reuses results up to a week old
+MAX_RESULT_REUSE_MINUTES = 7 * 24 * 60
+
+# Number of buckets, by principal ARN, of each month of the compacted table
+COMPACT_BUCKET_COUNT = 16
+
+# The principal of an event, which is the role that issued its session, or else the user
+PRINCIPAL_ARN = 'coalesce(useridentity.sessioncontext.sessionissuer.arn, useridentity.arn)'
+
+# Columns of the raw CloudTrail table that are kept in the compacted table
+COMPACT_COLUMNS = [
+    'useridentity',
+    'eventtime',
+    'eventsource',
+    'eventname',
+    'errorcode',
+    # Only needed for AssumeRole events, to follow role assumptions
+    "if(eventname = 'AssumeRole', requestparameters) as requestparameters",
+    "if(eventname = 'AssumeRole', responseelements) as responseelements",
+    'region',
+    PRINCIPAL_ARN + ' as principal_arn',
+]
+
+# Athena's default quota of concurrently running queries, per account and region
+MAX_CONCURRENT_QUERIES = 20
+
+# Defaults for how often running queries are checked on, in seconds
+POLL_INITIAL_INTERVAL = 0.2
+POLL_MAX_INTERVAL = 10
+POLL_BACKOFF = 2
+
+# Fraction of a query's execution time so far to wait before checking on it again
+POLL_ELAPSED_FRACTION = 0.2
+
+
+class QueryPoller(object):
+    """
+    Decides how long to wait between checks on running queries. The interval starts short,
+    so quick queries return quickly, and backs off exponentially with jitter up to a cap.
+    Queries that have already run for a while are likely to keep running, so the time they
+    have been executing is also used to estimate how long to wait.
+    """
+    interval = None
+    max_interval = None
+    backoff = None
+
+    def __init__(self, initial_interval=POLL_INITIAL_INTERVAL, max_interval=POLL_MAX_INTERVAL,
+                 backoff=POLL_BACKOFF):
+        self.interval = initial_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+
+    def next_delay(self, query_executions=()):
+        """Return the number of seconds to wait, given the QueryExecutions still running"""
+        delay = self.interval
+        self.interval = min(self.max_interval, self.interval * self.backoff)
+
+        # Base the estimate on the most recently started query, so the wait isn't too long for any of them
+        elapsed = [
+            query_execution['Statistics']['TotalExecutionTimeInMillis']
+            for query_execution in query_executions
+            if 'TotalExecutionTimeInMillis' in query_execution.get('Statistics', {})]
+        if len(elapsed) > 0:
+            delay = max(delay, min(elapsed) / 1000.0 * POLL_ELAPSED_FRACTION)
+
+        delay = min(delay, self.max_interval)
+        return random.uniform(delay / 2, delay)
+
+    def sleep(self, query_executions=()):
+        """Wait before checking on the given QueryExecutions again"""
+        delay = self.next_delay(query_executions)
+        logging.debug('Sleeping {:.2f} seconds while {} queries complete'.format(delay, len(query_executions)))
+        time.sleep(delay)
+
+class QueryIndex(object):
+    """
+    Remembers the QueryExecutionId of each successful query by a fingerprint of the query,
+    so that running the same query again can reuse its results instead of scanning the logs.
+    Results are only reused while they are younger than max_age_minutes.
+    """
+    path = None
+    max_age_minutes = None
+    lock = None
+
+    def __init__(self, max_age_minutes, directory=DEFAULT_CACHE_DIRECTORY):
+        self.path = os.path.join(os.path.expanduser(directory), QUERY_INDEX_FILE_NAME)
+        self.max_age_minutes = max_age_minutes
+        # Queries of several date ranges can complete at once, from different threads
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_fingerprint(query, context, output_bucket):
+        """
+        The SQL of a query names its table and date range, so together with where it runs it
+        identifies the results
+        """
+        return hashlib.sha256(json.dumps([query, context, output_bucket], sort_keys=True).encode('utf-8')).hexdigest()
+
+    def load(self):
+        """Return the queries that are still young enough to reuse"""
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, encoding='utf-8') as f:
+            queries = json.load(f)
+        oldest = time.time() - self.max_age_minutes * 60
+        return dict((fingerprint, query) for fingerprint, query in queries.items() if query['completed'] >= oldest)
+
+    def get(self, fingerprint):
+        """Return the QueryExecutionId of a query with the fingerprint that can be reused, or None"""
+        query = self.load().get(fingerprint)
+        if query is None:
+            return None
+        return query['QueryExecutionId']
+
+    def put(self, fingerprint, queryExecutionId):
+        with self.lock:
+            queries = self.load()
+            queries[fingerprint] = {'QueryExecutionId': queryExecutionId, 'completed': time.time()}
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'w', encoding='utf-8') as f:
+                json.dump(queries, f)
+
+
 class Athena(object):
     athena = None
     s3 = None
     database = 'cloudtracker'
     output_bucket = 'aws-athena-query-results-ACCOUNT_ID-REGION'
     search_filter = ''
+    date_filter = ''
+    account_id = ''
     table_name = ''
-
-
-    def query_athena(self, query, context={'Database': database}, do_not_wait=False, skip_header=True):
+    table_name_format = ''
+    raw_table_name = ''
+    cache_directory = DEFAULT_CACHE_DIRECTORY
+    partition_projection = False
+    compact = False
+    day_partitions = False
+    regions = None
+    max_concurrent_queries = MAX_CONCURRENT_QUERIES
+    poll_initial_interval = POLL_INITIAL_INTERVAL
+    poll_max_interval = POLL_MAX_INTERVAL
+    poll_backoff = POLL_BACKOFF
+    results_from_s3 = False
+    result_reuse_minutes = 0
+    query_index = None
+
+
+    def start_query(self, query, context={'Database': database}, reuse_results=False):
+        """Start a query and return its QueryExecutionId, without waiting for it to complete"""
         logging.debug('Making query {}'.format(query))
 
         # Make query request dependent on whether the context is None or not
-        if context is None:
-            response = self.athena.start_query_execution(
-                QueryString=query,
-                ResultConfiguration={'OutputLocation': self.output_bucket}
-            )
-        else:
-            response = self.athena.start_query_execution(
-                QueryString=query,
-                QueryExecutionContext=context,
-                ResultConfiguration={'OutputLocation': self.output_bucket}
-            )
+        kwargs = {}
+        if context is not None:
+            kwargs['QueryExecutionContext'] = context
+        if reuse_results and self.result_reuse_minutes > 0 and self.supports_result_reuse():
+            # Athena returns the results of an identical query, if one ran recently enough
+            kwargs['ResultReuseConfiguration'] = {'ResultReuseByAgeConfiguration': {
+                'Enabled': True,
+                'MaxAgeInMinutes': self.result_reuse_minutes}}
+        response = self.athena.start_query_execution(
+            QueryString=query,
+            ResultConfiguration={'OutputLocation': self.output_bucket},
+            **kwargs
+        )
+        return response['QueryExecutionId']
+
+
+    def query_athena(self, query, context={'Database': database}, do_not_wait=False, skip_header=True):
+        queryExecutionId = self.start_query(query, context)
 
         if do_not_wait:
-            return response['QueryExecutionId']
+            return queryExecutionId
+
+        self.wait_for_query_to_complete(queryExecutionId)
+        return self.get_query_results(queryExecutionId, skip_header)
+
 
-        self.wait_for_query_to_complete(response['QueryExecutionId'])
+    def stream_query(self, query, context={'Database': database}, skip_header=True):
+        """
+        Run a query and return a generator over its rows, so that large results can be
+        consumed without holding them all in memory.
+        """
+        if self.query_index is None:
+            queryExecutionId = self.start_query(query, context)
+            self.wait_for_query_to_complete(queryExecutionId)
+            return self.iter_query_results(queryExecutionId, skip_header)
+
+        # Reuse the results of the same query from a previous run, if they are recent enough
+        fingerprint = QueryIndex.get_fingerprint(query, context, self.output_bucket)
+        queryExecutionId = self.query_index.get(fingerprint)
+        if queryExecutionId is not None and self.has_results(queryExecutionId):
+            logging.debug('Reusing results of query {}'.format(queryExecutionId))
+            return self.iter_query_results(queryExecutionId, skip_header)
+
+        queryExecutionId = self.start_query(query, context, reuse_results=True)
+        self.wait_for_query_to_complete(queryExecutionId)
+        self.query_index.put(fingerprint, queryExecutionId)
+        return self.iter_query_results(queryExecutionId, skip_header)
+
+
+    def supports_result_reuse(self):
+        """Return True if the installed botocore knows of Athena's result reuse, which older versions don't"""
+        operation = self.athena.meta.service_model.operation_model('StartQueryExecution')
+        return 'ResultReuseConfiguration' in operation.input_shape.members
+
+
+    def has_results(self, queryExecutionId):
+        """
+        Return True if a query succeeded and its results can still be read, which they can't
+        once Athena has forgotten the query or the results have been deleted from S3.
+        """
+        try:
+            query_execution = self.athena.get_query_execution(QueryExecutionId=queryExecutionId)['QueryExecution']
+            if query_execution['Status']['State'] != 'SUCCEEDED':
+                return False
+            bucket, key = query_execution['ResultConfiguration']['OutputLocation'][len('s3://'):].split('/', 1)
+            self.s3.head_object(Bucket=bucket, Key=key)
+        except ClientError as e:
+            logging.debug('Not reusing results of query {}: {}'.format(queryExecutionId, e))
+            return False
+        return True
+
+
+    def run_queries(self, queries, context={'Database': database}, skip_header=True):
+        """
+        Run many queries concurrently, with at most max_concurrent_queries of them running at once.
+        Yields (query, rows) for each query as it completes, which is not necessarily in order.
+        """
+        pending = list(queries)
+        pending.reverse()
+        running = {}
+        poller = self.get_poller()
+
+        while len(pending) > 0 or len(running) > 0:
+            # Keep the pool full
+            started = False
+            while len(pending) > 0 and len(running) < self.max_concurrent_queries:
+                query = pending.pop()
+                running[self.start_query(query, context)] = query
+                started = True
+            if started:
+                # New queries were submitted, so check on them quickly
+                poller = self.get_poller()
+
+            completed, still_running = self.poll_query_batch(list(running))
+            for queryExecutionId in completed:
+                query = running.pop(queryExecutionId)
+                yield query, self.get_query_results(queryExecutionId, skip_header)
+
+            # Queries are only started again without waiting when some completed to make room for them
+            if len(running) > 0 and (len(completed) == 0 or len(pending) == 0):
+                poller.sleep(still_running)
+
+
+    def get_query_results(self, queryExecutionId, skip_header=True):
+        """Return the rows of a completed query"""
+        return list(self.iter_query_results(queryExecutionId, skip_header))
+
+
+    def iter_query_results(self, queryExecutionId, skip_header=True):
+        """Yield the rows of a completed query, one page at a time"""
+        if self.results_from_s3:
+            query_execution = self.athena.get_query_execution(QueryExecutionId=queryExecutionId)['QueryExecution']
+            # Only SELECT queries write their results as CSV
+            if query_execution.get('StatementType') == 'DML':
+                yield from self.iter_s3_results(query_execution, skip_header)
+                return
 
-        # Paginate results and combine them
-        rows = []
         paginator = self.athena.get_paginator('get_query_results')
-        response_iterator = paginator.paginate(QueryExecutionId=response['QueryExecutionId'])
+        response_iterator = paginator.paginate(QueryExecutionId=queryExecutionId)
         row_count = 0
         for response in response_iterator:
             for row in response['ResultSet']['Rows']:
@@ -85,8 +343,23 @@ class Athena(object):
                     if skip_header:
                         # Skip header
                         continue
-                rows.append(self.extract_response_values(row))
-        return rows
+                yield self.extract_response_values(row)
+
+
+    def iter_s3_results(self, query_execution, skip_header=True):
+        """
+        Yield the rows of a completed query by streaming the CSV file Athena wrote to S3,
+        which is much faster than paging through GetQueryResults 1000 rows at a time.
+        """
+        location = query_execution['ResultConfiguration']['OutputLocation']
+        bucket, key = location[len('s3://'):].split('/', 1)
+        response = self.s3.get_object(Bucket=bucket, Key=key)
+
+        rows = csv.reader(codecs.getreader('utf-8')(response['Body']))
+        if skip_header:
+            next(rows, None)
+        for row in rows:
+            yield row
 
 
     def extract_response_values(self, row):
@@ -96,84 +369,185 @@ class Athena(object):
         return result
 
 
+    def check_query_state(self, query_execution):
+        """
+        Returns True if the query succeeded, False if it is still running,
+        or raises an exception if it failed or was canceled.
+        """
+        state = query_execution['Status']['State']
+        if state == 'SUCCEEDED':
+            return True
+        if state == 'FAILED' or state == 'CANCELLED':
+            raise Exception('Query entered state {state} with reason {reason}'.format(
+                state=state,
+                reason=query_execution['Status'].get('StateChangeReason')))
+        return False
+
+
+    def get_poller(self):
+        """Return a QueryPoller with the configured intervals"""
+        return QueryPoller(self.poll_initial_interval, self.poll_max_interval, self.poll_backoff)
+
+
+    def poll_query_batch(self, queryExecutionIds):
+        """
+        Returns the ids of the queries that have completed successfully, and the QueryExecutions
+        of those still running, or raises an exception if any of them failed or were canceled.
+        """
+        completed = []
+        running = []
+        # BatchGetQueryExecution accepts at most 50 ids per call
+        for i in range(0, len(queryExecutionIds), 50):
+            response = self.athena.batch_get_query_execution(QueryExecutionIds=queryExecutionIds[i:i + 50])
+            for query_execution in response['QueryExecutions']:
+                if self.check_query_state(query_execution):
+                    completed.append(query_execution['QueryExecutionId'])
+                else:
+                    running.append(query_execution)
+        return completed, running
+
+
     def wait_for_query_to_complete(self, queryExecutionId):
         """
         Returns when the query completes successfully, or raises an exception if it fails or is canceled.
         Waits until the query finishes running.
         """
+        poller = self.get_poller()
 
         while True:
             response = self.athena.get_query_execution(QueryExecutionId=queryExecutionId)
-            state = response['QueryExecution']['Status']['State']
-            if state == 'SUCCEEDED':
+            if self.check_query_state(response['QueryExecution']):
                 return True
-            if state == 'FAILED' or state == 'CANCELLED':
-                raise Exception('Query entered state {state} with reason {reason}'.format(
-                    state=state,
-                    reason=response['QueryExecution']['Status']['StateChangeReason']))
-            logging.debug('Sleeping 1 second while query {} completes'.format(queryExecutionId))
-            time.sleep(1)
+            poller.sleep([response['QueryExecution']])
 
     def wait_for_query_batch_to_complete(self, queryExecutionIds):
         """
         Returns when the query completes successfully, or raises an exception if it fails or is canceled.
         Waits until the query finishes running.
         """
+        poller = self.get_poller()
 
+        queryExecutionIds = set(queryExecutionIds)
         while len(queryExecutionIds) > 0:
-            response = self.athena.batch_get_query_execution(QueryExecutionIds=list(queryExecutionIds))
-            for query_execution in response['QueryExecutions']:
-                state = query_execution['Status']['State']
-                if state == 'SUCCEEDED':
-                    queryExecutionIds.remove(query_execution['QueryExecutionId'])
-                if state == 'FAILED' or state == 'CANCELLED':
-                    raise Exception('Query entered state {state} with reason {reason}'.format(
-                        state=state,
-                        reason=response['QueryExecution']['Status']['StateChangeReason']))
+            completed, running = self.poll_query_batch(list(queryExecutionIds))
+            queryExecutionIds.difference_update(completed)
 
-                if len(queryExecutionIds) == 0:
-                    return
-                logging.debug('Sleeping 1 second while {} queries complete'.format(len(queryExecutionIds)))
-                time.sleep(1)
+            if len(queryExecutionIds) == 0:
+                return
+            poller.sleep(running)
 
 
-    def __init__(self, config, account, start, end, args):
+    def set_date_range(self, start, end):
+        """
+        Restrict the queries that follow to the dates from start to end, such as 2018-01-21.
+        Partitions are pruned by month, or by day when the table has day partitions, and the
+        eventtime of events is checked so that only the days asked for are counted.
+        """
+        month_restrictions = set()
+        for window_start, window_end in month_windows(start, end):
+            whole_month = is_whole_month(window_start, window_end)
+            window_start = datetime.datetime.strptime(window_start, '%Y-%m-%d').date()
+            window_end = datetime.datetime.strptime(window_end, '%Y-%m-%d').date()
+            restriction = '(year = \'{:0>2}\' and month = \'{:0>2}\''.format(window_start.year, window_start.month)
+
+            if self.day_partitions and not whole_month:
+                restriction += ' and day BETWEEN \'{:0>2}\' AND \'{:0>2}\''.format(window_start.day, window_end.day)
+            month_restrictions.add(restriction + ')')
+
+        # eventtime is an ISO 8601 timestamp, so it can be compared to dates as a string
+        end_date = datetime.datetime.strptime(end, '%Y-%m-%d').date() + datetime.timedelta(days=1)
+        time_filter = ' and eventtime >= \'{}\' and eventtime < \'{}\''.format(start, end_date.isoformat())
+
+        # Combine date filters, restrict to the regions with logs, and add error filter
+        region_filter = ''
+        if self.regions:
+            region_filter = ' and region IN ({})'.format(', '.join("'{}'".format(region) for region in self.regions))
+        self.search_filter = '((' + ' or '.join(sorted(month_restrictions)) + ')' + time_filter + region_filter + \
+            ' and errorcode IS NULL)'
+        # Other accounts may have logs in other regions
+        self.date_filter = '((' + ' or '.join(sorted(month_restrictions)) + ')' + time_filter + \
+            ' and errorcode IS NULL)'
+
+
+    def get_regions(self, config, account):
+        """
+        Return the regions that have CloudTrail logs, which are the prefixes under the account's
+        CloudTrail path in S3. These are remembered for REGION_CACHE_SECONDS, as listing a bucket
+        can be slow. The regions can also be set with the `regions` config setting.
+        """
+        if 'regions' in config:
+            return sorted(config['regions'])
+
+        prefix = '/'.join(part for part in [config['path'], 'AWSLogs', str(account['id']), 'CloudTrail'] if part) + '/'
+        cache_key = 's3://{}/{}'.format(config['s3_bucket'], prefix)
+        cache_file = os.path.join(os.path.expanduser(self.cache_directory), REGION_CACHE_FILE_NAME)
+
+        cached = {}
+        if os.path.exists(cache_file):
+            with open(cache_file, encoding='utf-8') as f:
+                cached = json.load(f)
+        if cache_key in cached and time.time() - cached[cache_key]['discovered'] < REGION_CACHE_SECONDS:
+            return cached[cache_key]['regions']
+
+        regions = set()
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=config['s3_bucket'], Prefix=prefix, Delimiter='/'):
+            for common_prefix in page.get('CommonPrefixes', []):
+                regions.add(common_prefix['Prefix'][len(prefix):].rstrip('/'))
+        regions = sorted(regions)
+        logging.info('Regions with CloudTrail logs: {}'.format(', '.join(regions)))
+
+        if len(regions) > 0:
+            cached[cache_key] = {'regions': regions, 'discovered': time.time()}
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            with open(cache_file, 'w', encoding='utf-8') as f:
+                json.dump(cached, f)
+        return regions
+
+
+    def get_cache_name(self):
+        """Identifies the data this datasource queries, for caching its results"""
+        return 'athena:{}.{}'.format(self.database, self.raw_table_name)
+
+
+    def __init__(self, config, account, start, end, args, cache_directory=DEFAULT_CACHE_DIRECTORY):
         # Mute boto except errors
         logging.getLogger('botocore').setLevel(logging.WARN)
         logging.info('Source of CloudTrail logs: s3://{bucket}/{path}'.format(
             bucket=config['s3_bucket'],
             path=config['path']))
         
+        self.cache_directory = cache_directory
+        self.partition_projection = config.get('partition_projection', False)
+
         # Check start date is not older than a year, as we only create partitions for that far back
-        if (datetime.datetime.now() - datetime.datetime.strptime(start, '%Y-%m-%d')).days > 365:
+        start_age = datetime.datetime.now() - datetime.datetime.strptime(start, '%Y-%m-%d')
+        if not self.partition_projection and start_age.days > 365:
             raise Exception("Start date is over a year old. CloudTracker does not create or use partitions over a year old.")
 
-        #
-        # Create date filtering
-        #
-        month_restrictions = set()
-        start = start.split('-')
-        end = end.split('-')
-
-        if start[0] == end[0]:
-            for month in range(int(start[1]), int(end[1]) + 1):
-                month_restrictions.add('(year = \'{:0>2}\' and month = \'{:0>2}\')'.format(start[0], month))
+        self.account_id = str(account['id'])
+        if self.partition_projection:
+            # Kept apart from the table whose partitions are created, as the two are set up differently
+            self.table_name_format = 'cloudtrail_projected_{}'
         else:
-            # Add restrictions for months in start year
-            for month in range(int(start[1]), 12 + 1):
-                month_restrictions.add('(year = \'{:0>2}\' and month = \'{:0>2}\')'.format(start[0], month))
-            # Add restrictions for months in middle years
-            for year in range(int(start[0]), int(end[0])):
-                for month in (1, 12 + 1):
-                    month_restrictions.add('(year = \'{:0>2}\' and month = \'{:0>2}\')'.format(year, month))
-            # Add restrictions for months in final year
-            for month in range(1, int(end[1]) + 1):
-                month_restrictions.add('(year = \'{:0>2}\' and month = \'{:0>2}\')'.format(end[0], month))
-        
-        # Combine date filters and add error filter
-        self.search_filter = '((' + ' or '.join(month_restrictions) + ') and errorcode IS NULL)'
-
-        self.table_name = 'cloudtrail_logs_{}'.format(account['id'])
+            self.table_name_format = 'cloudtrail_logs_{}'
+        self.raw_table_name = self.table_name_format.format(account['id'])
+        self.compact = config.get('compact', False)
+        if self.compact:
+            # Queries go through a view of the compacted table and the months not yet compacted
+            self.table_name_format = 'cloudtrail_view_{}'
+        self.table_name = self.table_name_format.format(account['id'])
+        if not self.compact:
+            # The projected table also has day partitions, which only it can be queried by
+            self.day_partitions = self.partition_projection
+        self.max_concurrent_queries = config.get('max_concurrent_queries', MAX_CONCURRENT_QUERIES)
+        self.poll_initial_interval = config.get('poll_initial_interval', POLL_INITIAL_INTERVAL)
+        self.poll_max_interval = config.get('poll_max_interval', POLL_MAX_INTERVAL)
+        self.poll_backoff = config.get('poll_backoff', POLL_BACKOFF)
+        self.results_from_s3 = config.get('results_from_s3', False)
+        self.result_reuse_minutes = min(config.get('result_reuse_minutes', 0), MAX_RESULT_REUSE_MINUTES)
+        if self.result_reuse_minutes > 0:
+            self.query_index = QueryIndex(self.result_reuse_minutes, self.cache_directory)
         
         #
         # Display the AWS identity (doubles as a check that boto creds are setup)
@@ -199,6 +573,9 @@ class Athena(object):
         self.athena = boto3.client('athena')
         self.s3 = boto3.client('s3')
 
+        self.regions = self.get_regions(config, account)
+        self.set_date_range(start, end)
+
         if args.skip_setup:
             logging.info("Skipping initial table creation")
             return
@@ -220,6 +597,9 @@ class Athena(object):
         #
         # Set up table
         #
+        partition_columns = 'region string, year string, month string'
+        if self.partition_projection:
+            partition_columns += ', day string'
         query = """CREATE EXTERNAL TABLE IF NOT EXISTS `{table_name}` (
             `eventversion` string COMMENT 'from deserializer', 
             `useridentity` struct<type:string,principalid:string,arn:string,accountid:string,invokedby:string,accesskeyid:string,username:string,sessioncontext:struct<attributes:struct<mfaauthenticated:string,creationdate:string>,sessionissuer:struct<type:string,principalid:string,arn:string,accountid:string,username:string>>> COMMENT 'from deserializer', 
@@ -244,34 +624,73 @@ class Athena(object):
             `serviceeventdetails` string COMMENT 'from deserializer', 
             `sharedeventid` string COMMENT 'from deserializer', 
             `vpcendpointid` string COMMENT 'from deserializer')
-            PARTITIONED BY (region string, year string, month string)
+            PARTITIONED BY ({partition_columns})
             ROW FORMAT SERDE 
             'com.amazon.emr.hive.serde.CloudTrailSerde' 
             STORED AS INPUTFORMAT 
             'com.amazon.emr.cloudtrail.CloudTrailInputFormat' 
             OUTPUTFORMAT 
             'org.apache.hadoop.hive.ql.io.HiveIgnoreKeyTextOutputFormat'
-            LOCATION '{cloudtrail_log_path}'""".format(
-                table_name=self.table_name,
-                cloudtrail_log_path=cloudtrail_log_path)
+            LOCATION '{cloudtrail_log_path}'
+            {table_properties}""".format(
+                table_name=self.raw_table_name,
+                partition_columns=partition_columns,
+                cloudtrail_log_path=cloudtrail_log_path,
+                table_properties=self.get_table_properties(cloudtrail_log_path))
         self.query_athena(query)
 
-        #
-        # Create partitions
-        #
+        if self.partition_projection:
+            logging.info('Using partition projection, so no partitions need to be created')
+        else:
+            self.create_partitions(cloudtrail_log_path, self.regions)
+
+        if self.compact:
+            self.setup_compaction(config, account)
+
 
+    def get_table_properties(self, cloudtrail_log_path):
+        """
+        Return the TBLPROPERTIES of the CloudTrail table. With partition projection, Athena
+        computes the partitions of a query from these properties, instead of them being created.
+        """
+        if not self.partition_projection:
+            return ''
+
+        # Using ec2 here just because it exists in all regions. Queries are restricted to the regions with logs.
+        regions = set(boto3.session.Session().get_available_regions('ec2')) | set(self.regions or [])
+        properties = [
+            ('projection.enabled', 'true'),
+            ('projection.region.type', 'enum'),
+            ('projection.region.values', ','.join(sorted(regions))),
+            ('projection.year.type', 'integer'),
+            ('projection.year.range', PROJECTION_YEAR_RANGE),
+            ('projection.month.type', 'integer'),
+            ('projection.month.range', '1,12'),
+            ('projection.month.digits', '2'),
+            ('projection.day.type', 'integer'),
+            ('projection.day.range', '1,31'),
+            ('projection.day.digits', '2'),
+            ('storage.location.template', cloudtrail_log_path + '/${region}/${year}/${month}/${day}/'),
+        ]
+        return 'TBLPROPERTIES (\n' + ',\n'.join(
+            "'{}'='{}'".format(key, value) for key, value in properties) + ')'
+
+
+    def create_partitions(self, cloudtrail_log_path, regions=None):
+        """Create the partitions of the given regions, or every region, for the past NUM_MONTHS_FOR_PARTITIONS months"""
         logging.info('Checking if all partitions for the past {} months exist'.format(NUM_MONTHS_FOR_PARTITIONS))
 
         # Get list of current partitions
-        query = 'SHOW PARTITIONS {table_name}'.format(table_name=self.table_name)
+        query = 'SHOW PARTITIONS {table_name}'.format(table_name=self.raw_table_name)
         partition_list = self.query_athena(query, skip_header=False)
 
         partition_set = set()
         for partition in partition_list:
             partition_set.add(partition[0])
 
-        # Get region list. Using ec2 here just because it exists in all regions.
-        regions = boto3.session.Session().get_available_regions('ec2')
+        if not regions:
+            # Get region list. Using ec2 here just because it exists in all regions.
+            regions = boto3.session.Session().get_available_regions('ec2')
 
         queries_to_make = set()
 
@@ -297,14 +716,138 @@ class Athena(object):
                     month=month,
                     cloudtrail_log_path=cloudtrail_log_path)
             if query != '':
-                queries_to_make.add('ALTER TABLE {table_name} ADD '.format(table_name=self.table_name) + query)
+                queries_to_make.add('ALTER TABLE {table_name} ADD '.format(table_name=self.raw_table_name) + query)
 
         # Run the queries
         query_count = len(queries_to_make)
-        for query in queries_to_make:
-            logging.info('Partition groups remaining to create: {}'.format(query_count))
-            self.query_athena(query)
+        logging.info('Partition groups remaining to create: {}'.format(query_count))
+        for _ in self.run_queries(queries_to_make):
             query_count -= 1
+            logging.info('Partition groups remaining to create: {}'.format(query_count))
+
+
+    def setup_compaction(self, config, account):
+        """
+        Maintain a compacted copy of the CloudTrail table, stored as Parquet and holding only the
+        columns CloudTracker queries, partitioned by year and month and bucketed by principal ARN.
+        Each month that has ended is compacted once, with a CTAS query writing into the month's
+        partition location. A view unions the compacted table with the months not yet compacted.
+        """
+        compact_table_name = 'cloudtrail_compact_{}'.format(account['id'])
+        compact_location = config.get(
+            'compact_location',
+            '{}/cloudtracker-compact/{}'.format(self.output_bucket.rstrip('/'), account['id'])).rstrip('/')
+        bucket_count = config.get('compact_bucket_count', COMPACT_BUCKET_COUNT)
+
+        query = """CREATE EXTERNAL TABLE IF NOT EXISTS `{table_name}` (
+            `useridentity` struct<type:string,principalid:string,arn:string,accountid:string,invokedby:string,accesskeyid:string,username:string,sessioncontext:struct<attributes:struct<mfaauthenticated:string,creationdate:string>,sessionissuer:struct<type:string,principalid:string,arn:string,accountid:string,username:string>>>,
+            `eventtime` string,
+            `eventsource` string,
+            `eventname` string,
+            `errorcode` string,
+            `requestparameters` string,
+            `responseelements` string,
+            `region` string,
+            `principal_arn` string)
+            PARTITIONED BY (year string, month string)
+            CLUSTERED BY (principal_arn) INTO {bucket_count} BUCKETS
+            STORED AS PARQUET
+            LOCATION '{location}/'""".format(
+                table_name=compact_table_name,
+                bucket_count=bucket_count,
+                location=compact_location)
+        self.query_athena(query)
+
+        query = 'SHOW PARTITIONS {table_name}'.format(table_name=compact_table_name)
+        compacted = set(partition[0] for partition in self.query_athena(query, skip_header=False))
+
+        # Compact the months that no more logs will be delivered for
+        months_to_compact = []
+        for num_months_ago in range(1, NUM_MONTHS_FOR_PARTITIONS):
+            first_day = datetime.date.today().replace(day=1) - relativedelta(months=num_months_ago)
+            last_day = first_day + relativedelta(months=1) - datetime.timedelta(days=1)
+            year = str(first_day.year)
+            month = '{:0>2}'.format(first_day.month)
+            if is_closed(last_day.isoformat()) and 'year={}/month={}'.format(year, month) not in compacted:
+                months_to_compact.append((year, month))
+
+        if len(months_to_compact) > 0:
+            logging.info('Compacting {} months of CloudTrail logs'.format(len(months_to_compact)))
+
+            # Clean up after any compaction that failed partway, as CTAS needs a new table and an empty location
+            for _ in self.run_queries(['DROP TABLE IF EXISTS {table_name}_{year}{month}'.format(
+                    table_name=compact_table_name, year=year, month=month) for year, month in months_to_compact]):
+                pass
+            for year, month in months_to_compact:
+                self.delete_s3_prefix('{location}/year={year}/month={month}/'.format(
+                    location=compact_location, year=year, month=month))
+
+            queries = {}
+            for year, month in months_to_compact:
+                query = """CREATE TABLE {table_name}_{year}{month}
+                    WITH (format = 'PARQUET', external_location = '{location}/year={year}/month={month}/',
+                          bucketed_by = ARRAY['principal_arn'], bucket_count = {bucket_count})
+                    AS SELECT {columns} FROM {raw_table_name}
+                    WHERE year = '{year}' AND month = '{month}' AND errorcode IS NULL""".format(
+                        table_name=compact_table_name,
+                        location=compact_location,
+                        bucket_count=bucket_count,
+                        columns=', '.join(COMPACT_COLUMNS),
+                        raw_table_name=self.raw_table_name,
+                        year=year,
+                        month=month)
+                queries[query] = (year, month)
+
+            for query, _ in self.run_queries(queries):
+                year, month = queries[query]
+                # The data stays in the partition's location when the temporary table is dropped
+                self.query_athena(
+                    "ALTER TABLE {table_name} ADD IF NOT EXISTS PARTITION (year='{year}', month='{month}') "
+                    "LOCATION '{location}/year={year}/month={month}/'".format(
+                        table_name=compact_table_name, location=compact_location, year=year, month=month))
+                self.query_athena('DROP TABLE IF EXISTS {table_name}_{year}{month}'.format(
+                    table_name=compact_table_name, year=year, month=month))
+                compacted.add('year={}/month={}'.format(year, month))
+
+        # Months that have been compacted are read from the compacted table, the others from the raw one
+        compacted_months = sorted(
+            "'{}'".format(partition.replace('year=', '').replace('/month=', '')) for partition in compacted)
+        raw_filter = ''
+        if len(compacted_months) > 0:
+            raw_filter = 'WHERE concat(year, month) NOT IN ({})'.format(', '.join(compacted_months))
+        columns = 'useridentity, eventtime, eventsource, eventname, errorcode, requestparameters, responseelements, ' \
+            'region, {principal_arn} as principal_arn, year, month'
+        self.query_athena(
+            """CREATE OR REPLACE VIEW {view_name} AS
+            SELECT {compact_columns} FROM {compact_table_name}
+            UNION ALL
+            SELECT {raw_columns} FROM {raw_table_name} {raw_filter}""".format(
+                view_name=self.table_name,
+                compact_columns=columns.format(principal_arn='principal_arn'),
+                raw_columns=columns.format(principal_arn=PRINCIPAL_ARN),
+                compact_table_name=compact_table_name,
+                raw_table_name=self.raw_table_name,
+                raw_filter=raw_filter))
+
+
+    def delete_s3_prefix(self, location):
+        """Delete the objects under an S3 location, such as s3://bucket/path/"""
+        bucket, prefix = location[len('s3://'):].split('/', 1)
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            objects = [{'Key': item['Key']} for item in page.get('Contents', [])]
+            if len(objects) > 0:
+                self.s3.delete_objects(Bucket=bucket, Delete={'Objects': objects})
+
+
+    def get_principal_filter(self, arn):
+        """
+        Return a restriction of a query to the events of a principal, which lets the buckets of
+        the compacted table be pruned. Without compaction there are no buckets to prune.
+        """
+        if not self.compact:
+            return ''
+        return 'principal_arn = \'{}\' and '.format(arn)
 
 
     def get_performed_users(self):
@@ -314,7 +857,7 @@ class Athena(object):
         query = 'select distinct userIdentity.userName from {table_name} where {search_filter}'.format(
             table_name=self.table_name,
             search_filter=self.search_filter)
-        response = self.query_athena(query)
+        response = self.stream_query(query)
         
         user_names = {}
         for row in response:
@@ -333,7 +876,7 @@ class Athena(object):
         query = 'select distinct userIdentity.sessionContext.sessionIssuer.userName from {table_name} where {search_filter}'.format(
             table_name=self.table_name,
             search_filter=self.search_filter)
-        response = self.query_athena(query)
+        response = self.stream_query(query)
 
         role_names = {}
         for row in response:
@@ -347,44 +890,36 @@ class Athena(object):
         return None
 
 
-    def get_events_from_search(self, searchresults):
+    def get_events_from_search(self, searchresults, event_names=None):
         """
-        Given the results of a query for events, return these in a more usable fashion
+        Given the rows of a query for events, whose first two columns are the eventsource
+        and eventname, return these in a more usable fashion
         """
-        event_names = {}
-
-        for event in searchresults:
-            event = event[0]
-            # event is now a string like "{field0=s3.amazonaws.com, field1=GetBucketAcl}"
-            # I parse out the field manually
-            # TODO Find a smarter way to parse this data
-
-            # Remove the '{' and '}'
-            event = event[1:len(event)-1]
+        if event_names is None:
+            event_names = {}
 
-            # Split into 'field0=s3.amazonaws.com' and 'field1=GetBucketAcl'
-            event = event.split(", ")
-            # Get the eventsource 's3.amazonaws.com'
-            service = event[0].split('=')[1]
-            # Get the service 's3'
-            service = service.split(".")[0]
+        for row in searchresults:
+            event_names[self.get_event_name(row[0], row[1])] = True
 
-            # Get the eventname 'GetBucketAcl'
-            eventname = event[1].split('=')[1]
+        return event_names
 
-            event_names[normalize_api_call(service, eventname)] = True
 
-        return event_names
+    def get_event_name(self, eventsource, eventname):
+        """Given an eventsource such as 's3.amazonaws.com' and an eventname, return the normalized API call"""
+        return normalize_api_call(eventsource.split(".", 1)[0], eventname)
 
 
     def get_performed_event_names_by_user(self, _, user_iam):
         """For a user, return all performed events"""
 
-        query = 'select distinct (eventsource, eventname) from {table_name} where (userIdentity.arn = \'{identity}\') and {search_filter}'.format(
-            table_name=self.table_name,
-            identity=user_iam['Arn'],
-            search_filter=self.search_filter)
-        response = self.query_athena(query)
+        query = (
+            'select distinct eventsource, eventname from {table_name} '
+            'where {principal_filter}(userIdentity.arn = \'{identity}\') and {search_filter}').format(
+                table_name=self.table_name,
+                principal_filter=self.get_principal_filter(user_iam['Arn']),
+                identity=user_iam['Arn'],
+                search_filter=self.search_filter)
+        response = self.stream_query(query)
         
         return self.get_events_from_search(response)
 
@@ -392,59 +927,132 @@ class Athena(object):
     def get_performed_event_names_by_role(self, _, role_iam):
         """For a role, return all performed events"""
         
-        query = 'select distinct (eventsource, eventname) from {table_name} where (userIdentity.sessionContext.sessionIssuer.arn = \'{identity}\') and {search_filter}'.format(
-            table_name=self.table_name,
-            identity=role_iam['Arn'],
-            search_filter=self.search_filter)
-        response = self.query_athena(query)
+        query = (
+            'select distinct eventsource, eventname from {table_name} '
+            'where {principal_filter}(userIdentity.sessionContext.sessionIssuer.arn = \'{identity}\') '
+            'and {search_filter}').format(
+                table_name=self.table_name,
+                principal_filter=self.get_principal_filter(role_iam['Arn']),
+                identity=role_iam['Arn'],
+                search_filter=self.search_filter)
+        response = self.stream_query(query)
 
         return self.get_events_from_search(response)
 
 
-    def get_performed_event_names_by_user_in_role(self, searchquery, user_iam, role_iam):
-        """For a user that has assumed into another role, return all performed events"""
-        raise Exception("Not implemented")
-        sessionquery = searchquery.query(self.get_query_match('eventName', 'AssumeRole')) \
-            .query(self.get_query_match('userIdentity.arn', user_iam['Arn'])) \
-            .query(self.get_query_match('requestParameters.roleArn', role_iam['Arn']))
-
-        event_names = {}
-        for roleAssumption in sessionquery.scan():
-            sessionKey = roleAssumption.responseElements.credentials.accessKeyId
-            # I assume the session key is unique enough to use for identifying role assumptions
-            # TODO: I should also be using sharedEventID as explained in:
-            # https://aws.amazon.com/blogs/security/aws-cloudtrail-now-tracks-cross-account-activity-to-its-origin/
-            # I could also use the timings of these events.
-            innerquery = searchquery.query(self.get_query_match('userIdentity.accessKeyId', sessionKey)) \
-                .query(self.get_query_match('userIdentity.sessionContext.sessionIssuer.arn', role_iam['Arn']))
-
-            event_names.update(self.get_events_from_search(innerquery))
+    def get_events_from_role_assumptions(self, caller_arn, caller_filter, role_iam):
+        """
+        Return all performed events of the sessions created by the AssumeRole events of a caller
+        into a role. This is a single query, that joins the role assumptions to the events made
+        with the access keys they issued. When the role is in another account, its events are
+        looked for in the table of that account, which must have been set up by CloudTracker.
+        """
+        role_account_id = role_iam['Arn'].split(':')[4]
+        if role_account_id == self.account_id:
+            role_table_name = self.table_name
+            role_search_filter = self.search_filter
+        else:
+            role_table_name = self.table_name_format.format(role_account_id)
+            role_search_filter = self.date_filter
+
+        # I assume the session key is unique enough to use for identifying role assumptions
+        # TODO: I should also be using sharedEventID as explained in:
+        # https://aws.amazon.com/blogs/security/aws-cloudtrail-now-tracks-cross-account-activity-to-its-origin/
+        query = """with sessions as (
+                select distinct json_extract_scalar(responseelements, '$.credentials.accessKeyId') as session_key
+                from {table_name}
+                where {caller_principal_filter}eventname = 'AssumeRole' and {caller_filter}
+                and json_extract_scalar(requestparameters, '$.roleArn') = '{role_arn}'
+                and {search_filter}
+            ), role_events as (
+                select eventsource, eventname, useridentity.accesskeyid as session_key
+                from {role_table_name}
+                where {role_principal_filter}useridentity.sessioncontext.sessionissuer.arn = '{role_arn}'
+                and {role_search_filter}
+            )
+            select distinct role_events.eventsource, role_events.eventname
+            from role_events join sessions on role_events.session_key = sessions.session_key""".format(
+                table_name=self.table_name,
+                caller_principal_filter=self.get_principal_filter(caller_arn),
+                caller_filter=caller_filter,
+                role_principal_filter=self.get_principal_filter(role_iam['Arn']),
+                role_arn=role_iam['Arn'],
+                search_filter=self.search_filter,
+                role_table_name=role_table_name,
+                role_search_filter=role_search_filter)
+        response = self.stream_query(query)
 
-        return event_names
+        return self.get_events_from_search(response)
+
+
+    def get_performed_event_names_by_user_in_role(self, _, user_iam, role_iam):
+        """For a user that has assumed into another role, return all performed events"""
+        caller_filter = 'userIdentity.arn = \'{}\''.format(user_iam['Arn'])
+        return self.get_events_from_role_assumptions(user_iam['Arn'], caller_filter, role_iam)
 
 
-    def get_performed_event_names_by_role_in_role(self, searchquery, role_iam, dest_role_iam):
+    def get_performed_event_names_by_role_in_role(self, _, role_iam, dest_role_iam):
         """For a role that has assumed into another role, return all performed events"""
-        raise Exception("Not implemented")
-        sessionquery = searchquery.query(self.get_query_match('eventName', 'AssumeRole')) \
-            .query(self.get_query_match('userIdentity.sessionContext.sessionIssuer.arn', role_iam['Arn'])) \
-            .query(self.get_query_match('requestParameters.roleArn', dest_role_iam['Arn']))
-
-        # TODO I should get a count of the number of role assumptions, since this can be millions
-
-        event_names = {}
-        count = 0
-        for roleAssumption in sessionquery.scan():
-            count += 1
-            if count % 1000 == 0:
-                # This is just info level information, for cases where many role assumptions have happened
-                # I should advise the user to just look at the final role, especially for cases where the same role
-                # is continuously assuming into another role and that is the only thing assuming into it.
-                print("{} role assumptions scanned so far...".format(count))
-            sessionKey = roleAssumption.responseElements.credentials.accessKeyId
-            innerquery = searchquery.query(self.get_query_match('userIdentity.accessKeyId', sessionKey)) \
-                .query(self.get_query_match('userIdentity.sessionContext.sessionIssuer.arn', dest_role_iam['Arn']))
-
-            event_names.update(self.get_events_from_search(innerquery))
+        caller_filter = 'userIdentity.sessionContext.sessionIssuer.arn = \'{}\''.format(role_iam['Arn'])
+        return self.get_events_from_role_assumptions(role_iam['Arn'], caller_filter, dest_role_iam)
 
-        return event_names
+
+    def get_performed_event_names_by_principals(self, _):
+        """
+        Return all performed events of every user and role, as a dict of the principal's ARN to
+        its events. This is a single grouped query, rather than one query per principal.
+        """
+        query = (
+            'select eventsource, eventname, '
+            'if(userIdentity.sessionContext.sessionIssuer.arn is null, userIdentity.arn), '
+            'userIdentity.sessionContext.sessionIssuer.arn '
+            'from {table_name} where {search_filter} group by 1, 2, 3, 4').format(
+                table_name=self.table_name,
+                search_filter=self.search_filter)
+        response = self.stream_query(query)
+
+        # Many principals perform the same events, so each is only normalized once
+        normalized = {}
+        principals = {}
+        for row in response:
+            event_name = normalized.get((row[0], row[1]))
+            if event_name is None:
+                event_name = self.get_event_name(row[0], row[1])
+                normalized[(row[0], row[1])] = event_name
+
+            # Users are matched on their own ARN, roles on the ARN of the role their session was issued by
+            if row[2] != '':
+                principals.setdefault(row[2], {})[event_name] = True
+            if row[3] != '':
+                principals.setdefault(row[3], {})[event_name] = True
+        return principals
+
+
+    def get_action_rollups(self, _):
+        """
+        Return when and how often every user and role performed each event, as a list of
+        (principal ARN, event, first seen, last seen, count), from a single grouped query.
+        """
+        query = (
+            'select eventsource, eventname, '
+            'if(userIdentity.sessionContext.sessionIssuer.arn is null, userIdentity.arn), '
+            'userIdentity.sessionContext.sessionIssuer.arn, min(eventtime), max(eventtime), count(*) '
+            'from {table_name} where {search_filter} group by 1, 2, 3, 4').format(
+                table_name=self.table_name,
+                search_filter=self.search_filter)
+        response = self.stream_query(query)
+
+        normalized = {}
+        rollups = []
+        for row in response:
+            event_name = normalized.get((row[0], row[1]))
+            if event_name is None:
+                event_name = self.get_event_name(row[0], row[1])
+                normalized[(row[0], row[1])] = event_name
+
+            for arn in (row[2], row[3]):
+                if arn != '':
+                    rollups.append((arn, event_name, row[4], row[5], int(row[6])))
+
+        # Different event names can normalize to the same event, such as dated API versions
+        return merge_rollups(rollups)
@@ -23,10 +23,35 @@ USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 ---------------------------------------------------------------------------
 """
 
+import logging
+
 from elasticsearch import Elasticsearch
 from elasticsearch_dsl import Search, Q
 from cloudtracker import normalize_api_call
 
+# Number of buckets fetched by each page of a composite aggregation
+COMPOSITE_PAGE_SIZE = 1000
+
+# Number of buckets of terms aggregations, for versions without composite aggregations
+TERMS_SIZE = 5000
+
+# Number of role assumption session keys whose events are searched for at once
+SESSION_KEY_CHUNK_SIZE = 1000
+
+# Seconds to wait for each request, unless a timeout is configured
+DEFAULT_TIMEOUT = 900
+
+# Settings of the config that are passed to the client, for its connection pool, retries and sniffing
+CONNECTION_SETTINGS = [
+    'maxsize',
+    'max_retries',
+    'retry_on_timeout',
+    'dead_timeout',
+    'sniff_on_start',
+    'sniff_on_connection_fail',
+    'sniffer_timeout',
+]
+
 class ElasticSearch(object):
     es = None
     index = "cloudtrail"
@@ -35,10 +60,15 @@ class ElasticSearch(object):
     # Create search filters
     searchfilter = None
 
+    es_version = None
+    es_minor_version = 0
+
 
     def __init__(self, config, start, end):
-        # Open connection to ElasticSearch
-        self.es = Elasticsearch([config], timeout=900)
+        # Open connection to ElasticSearch, spreading requests over the hosts if there are several
+        hosts = config.get('hosts', [config])
+        settings = dict((setting, config[setting]) for setting in CONNECTION_SETTINGS if setting in config)
+        self.es = Elasticsearch(hosts, timeout=config.get('timeout', DEFAULT_TIMEOUT), **settings)
         self.searchfilter = {}
         self.index = config.get('index', 'cloudtrail')
         self.key_prefix = config.get('key_prefix', '')
@@ -47,22 +77,31 @@ class ElasticSearch(object):
         self.timestamp_field = config.get('timestamp_field', 'eventTime')
 
         # Used to make elasticsearch query language semantics dynamically based on version
-        self.es_version = int(self.es.info()['version']['number'].split('.')[0])
+        version = self.es.info()['version']['number'].split('.')
+        self.es_version = int(version[0])
+        self.es_minor_version = int(version[1])
 
         # Filter errors
         # https://www.elastic.co/guide/en/elasticsearch/reference/2.0/breaking_20_query_dsl_changes.html
         # http://www.dlxedu.com/askdetail/3/0620e1124992fb281da93c7efe53b97f.html
-        if self.es_version < 2:
-            error_filter = {'exists': {'field': self.get_field_name('errorCode')}}
-            self.searchfilter['filter_errors'] = ~Q('filtered', filter=error_filter)
-        else:
-            self.searchfilter['filter_errors'] = ~Q('exists', field=self.get_field_name('errorCode'))
+        self.searchfilter['filter_errors'] = ~self.get_exists_query(self.get_field_name('errorCode'))
 
         # Filter dates
+        self.set_date_range(start, end)
+
+    def set_date_range(self, start, end):
+        """Restrict the searches that follow to the dates from start to end, such as 2018-01-21"""
+        self.searchfilter.pop('start_date_filter', None)
+        self.searchfilter.pop('end_date_filter', None)
+        # Dates are rounded to whole days, so that the same filters are used all day and can be cached
         if start:
-            self.searchfilter['start_date_filter'] = Q('range', **{self.timestamp_field: {'gte': start}})
+            self.searchfilter['start_date_filter'] = Q('range', **{self.timestamp_field: {'gte': start + '||/d'}})
         if end:
-            self.searchfilter['end_date_filter'] = Q('range', **{self.timestamp_field: {'lte': end}})
+            self.searchfilter['end_date_filter'] = Q('range', **{self.timestamp_field: {'lte': end + '||/d'}})
+
+    def get_cache_name(self):
+        """Identifies the data this datasource searches, for caching its results"""
+        return 'elasticsearch:{}'.format(self.index)
 
     def get_field_name(self, field):
         return self.key_prefix + field + self.get_field_suffix()
@@ -78,27 +117,80 @@ class ElasticSearch(object):
         else:
             return ".keyword"
 
+    def get_exists_query(self, field):
+        """Return a query for the documents that have a field, which before 2.0 was only a filter"""
+        if self.es_version < 2:
+            return Q('filtered', filter={'exists': {'field': field}})
+        return Q('exists', field=field)
+
     def get_query_match(self, field, value):
         field = self.get_field_name(field)
         return {'match': {field: value}}
 
+    def iter_buckets(self, search, sources):
+        """
+        Yield the distinct combinations of values of the fields in sources, a list of (name, field),
+        as dicts of name to value. Composite aggregations are paged through with an after key, so
+        any number of combinations is returned without the cluster building them all at once.
+        """
+        # Only aggregations are needed, not hits, so the shard request cache can answer repeated searches
+        search = search.extra(size=0)
+        if self.es_version >= 2:
+            search = search.params(request_cache='true')
+
+        if (self.es_version, self.es_minor_version) < (6, 1):
+            # Composite aggregations were added in 6.1, so nest terms aggregations instead
+            aggs = search.aggs
+            for name, field in sources:
+                aggs = aggs.bucket(name, 'terms', field=field, size=TERMS_SIZE)
+            response = search.execute()
+            yield from self.iter_terms_buckets(response.aggregations, [name for name, _ in sources], {})
+            return
+
+        after = None
+        while True:
+            composite = {
+                'sources': [{name: {'terms': {'field': field}}} for name, field in sources],
+                'size': COMPOSITE_PAGE_SIZE,
+            }
+            if after is not None:
+                composite['after'] = after
+            # Built as a dict, as older versions of elasticsearch_dsl don't know of composite aggregations
+            response = search.extra(aggs={'buckets': {'composite': composite}}).execute()
+
+            buckets = response.to_dict()['aggregations']['buckets']['buckets']
+            for bucket in buckets:
+                yield bucket['key']
+            if len(buckets) < COMPOSITE_PAGE_SIZE:
+                return
+            after = buckets[-1]['key']
+
+    def iter_terms_buckets(self, aggregations, names, key):
+        """Yield the keys of nested terms aggregations, as iter_buckets does for composite aggregations"""
+        aggregation = getattr(aggregations, names[0])
+        if getattr(aggregation, 'sum_other_doc_count', 0) > 0:
+            # Terms aggregations can't be paged, so anything past the first TERMS_SIZE buckets is left out
+            logging.warning('{} events were left out of the results, as there are over {} values of {}'.format(
+                aggregation.sum_other_doc_count, TERMS_SIZE, names[0]))
+        for bucket in aggregation.buckets:
+            bucket_key = dict(key)
+            bucket_key[names[0]] = bucket.key
+            if len(names) == 1:
+                yield bucket_key
+            else:
+                yield from self.iter_terms_buckets(bucket, names[1:], bucket_key)
+
     def get_performed_users(self):
         """
         Returns the users that performed actions within the search filters
         """
-        search = Search(using=self.es, index=self.index)
-        for query in self.searchfilter.values():
-            search = search.query(query)
-
-        search.aggs.bucket('user_names', 'terms', field=self.get_field_name('userIdentity.userName'), size=5000)
-        response = search.execute()
-
         user_names = {}
-        for user in response.aggregations.user_names.buckets:
-            if user.key == 'HIDDEN_DUE_TO_SECURITY_REASONS':
+        sources = [('user_name', self.get_field_name('userIdentity.userName'))]
+        for bucket in self.iter_buckets(self.get_search_query(), sources):
+            if bucket['user_name'] == 'HIDDEN_DUE_TO_SECURITY_REASONS':
                 # This happens when a user logs in with the wrong username
                 continue
-            user_names[user.key] = True
+            user_names[bucket['user_name']] = True
         return user_names
 
 
@@ -106,27 +198,24 @@ class ElasticSearch(object):
         """
         Returns the roles that performed actions within the search filters
         """
-        search = Search(using=self.es, index=self.index)
-        for query in self.searchfilter.values():
-            search = search.query(query)
-
-        userName_field = self.get_field_name('userIdentity.sessionContext.sessionIssuer.userName')
-        search.aggs.bucket('role_names', 'terms', field=userName_field, size=5000)
-        response = search.execute()
-
         role_names = {}
-        for role in response.aggregations.role_names.buckets:
-            role_names[role.key] = True
+        sources = [('role_name', self.get_field_name('userIdentity.sessionContext.sessionIssuer.userName'))]
+        for bucket in self.iter_buckets(self.get_search_query(), sources):
+            role_names[bucket['role_name']] = True
         return role_names
 
 
     def get_search_query(self):
         """
-        Opens a connection to ElasticSearch and applies the initial filters
+        Opens a connection to ElasticSearch and applies the initial filters, in filter context
         """
         search = Search(using=self.es, index=self.index)
         for query in self.searchfilter.values():
-            search = search.query(query)
+            if self.es_version < 2:
+                search = search.query(query)
+            else:
+                # Filters are not scored, and are cached by the shards
+                search = search.filter(query)
 
         return search
 
@@ -136,17 +225,15 @@ class ElasticSearch(object):
         return the API calls that exist for this query.
         s: search query
         """
-        searchquery.aggs.bucket('event_names', 'terms', field=self.get_field_name('eventName'), size=5000) \
-            .bucket('service_names', 'terms', field=self.get_field_name('eventSource'), size=5000)
-        response = searchquery.execute()
+        sources = [
+            ('event_source', self.get_field_name('eventSource')),
+            ('event_name', self.get_field_name('eventName')),
+        ]
 
         event_names = {}
-
-        for event in response.aggregations.event_names.buckets:
-            service = event.service_names.buckets[0].key
-            service = service.split(".")[0]
-
-            event_names[normalize_api_call(service, event.key)] = True
+        for bucket in self.iter_buckets(searchquery, sources):
+            service = bucket['event_source'].split(".")[0]
+            event_names[normalize_api_call(service, bucket['event_name'])] = True
 
         return event_names
 
@@ -164,20 +251,27 @@ class ElasticSearch(object):
         return self.get_events_from_search(searchquery)
 
 
-    def get_performed_event_names_by_user_in_role(self, searchquery, user_iam, role_iam):
-        """For a user that has assumed into another role, return all performed events"""
-        sessionquery = searchquery.query(self.get_query_match('eventName', 'AssumeRole')) \
-            .query(self.get_query_match('userIdentity.arn', user_iam['Arn'])) \
-            .query(self.get_query_match('requestParameters.roleArn', role_iam['Arn']))
+    def get_events_from_sessions(self, searchquery, sessionquery, role_iam):
+        """
+        Given a query of AssumeRole events, return the API calls made with the sessions they created
+        in the role. The session keys are collected with an aggregation, and their events are then
+        searched for in chunks of SESSION_KEY_CHUNK_SIZE keys, rather than one search per session.
+        """
+        key_field = self.get_field_name('responseElements.credentials.accessKeyId')
+        # I assume the session key is unique enough to use for identifying role assumptions
+        # TODO: I should also be using sharedEventID as explained in:
+        # https://aws.amazon.com/blogs/security/aws-cloudtrail-now-tracks-cross-account-activity-to-its-origin/
+        # I could also use the timings of these events.
+        session_keys = [
+            bucket['session_key'] for bucket in self.iter_buckets(sessionquery, [('session_key', key_field)])]
 
         event_names = {}
-        for roleAssumption in sessionquery.scan():
-            sessionKey = roleAssumption.responseElements.credentials.accessKeyId
-            # I assume the session key is unique enough to use for identifying role assumptions
-            # TODO: I should also be using sharedEventID as explained in:
-            # https://aws.amazon.com/blogs/security/aws-cloudtrail-now-tracks-cross-account-activity-to-its-origin/
-            # I could also use the timings of these events.
-            innerquery = searchquery.query(self.get_query_match('userIdentity.accessKeyId', sessionKey)) \
+        for i in range(0, len(session_keys), SESSION_KEY_CHUNK_SIZE):
+            if i > 0:
+                # This is just info level information, for cases where many role assumptions have happened
+                print("{} of {} role assumptions searched so far...".format(i, len(session_keys)))
+            chunk = session_keys[i:i + SESSION_KEY_CHUNK_SIZE]
+            innerquery = searchquery.query(Q('terms', **{self.get_field_name('userIdentity.accessKeyId'): chunk})) \
                 .query(self.get_query_match('userIdentity.sessionContext.sessionIssuer.arn', role_iam['Arn']))
 
             event_names.update(self.get_events_from_search(innerquery))
@@ -185,27 +279,48 @@ class ElasticSearch(object):
         return event_names
 
 
+    def get_performed_event_names_by_principals(self, searchquery):
+        """
+        Return all performed events of every user and role, as a dict of the principal's ARN to
+        its events. Events are bucketed by the ARN of the role that issued their session, or of
+        the user when there is none, so this is two aggregations rather than one per principal.
+        """
+        role_field = self.get_field_name('userIdentity.sessionContext.sessionIssuer.arn')
+        searches = [
+            (searchquery.query(self.get_exists_query(role_field)), role_field),
+            (searchquery.query(~self.get_exists_query(role_field)), self.get_field_name('userIdentity.arn')),
+        ]
+
+        principals = {}
+        for search, principal_field in searches:
+            sources = [
+                ('principal', principal_field),
+                ('event_source', self.get_field_name('eventSource')),
+                ('event_name', self.get_field_name('eventName')),
+            ]
+            for bucket in self.iter_buckets(search, sources):
+                service = bucket['event_source'].split(".")[0]
+                event_names = principals.setdefault(bucket['principal'], {})
+                event_names[normalize_api_call(service, bucket['event_name'])] = True
+
+        return principals
+
+
+    def get_performed_event_names_by_user_in_role(self, searchquery, user_iam, role_iam):
+        """For a user that has assumed into another role, return all performed events"""
+        sessionquery = searchquery.query(self.get_query_match('eventName', 'AssumeRole')) \
+            .query(self.get_query_match('userIdentity.arn', user_iam['Arn'])) \
+            .query(self.get_query_match('requestParameters.roleArn', role_iam['Arn']))
+
+        return self.get_events_from_sessions(searchquery, sessionquery, role_iam)
+
+
     def get_performed_event_names_by_role_in_role(self, searchquery, role_iam, dest_role_iam):
         """For a role that has assumed into another role, return all performed events"""
         sessionquery = searchquery.query(self.get_query_match('eventName', 'AssumeRole')) \
             .query(self.get_query_match('userIdentity.sessionContext.sessionIssuer.arn', role_iam['Arn'])) \
             .query(self.get_query_match('requestParameters.roleArn', dest_role_iam['Arn']))
 
-        # TODO I should get a count of the number of role assumptions, since this can be millions
-
-        event_names = {}
-        count = 0
-        for roleAssumption in sessionquery.scan():
-            count += 1
-            if count % 1000 == 0:
-                # This is just info level information, for cases where many role assumptions have happened
-                # I should advise the user to just look at the final role, especially for cases where the same role
-                # is continuously assuming into another role and that is the only thing assuming into it.
-                print("{} role assumptions scanned so far...".format(count))
-            sessionKey = roleAssumption.responseElements.credentials.accessKeyId
-            innerquery = searchquery.query(self.get_query_match('userIdentity.accessKeyId', sessionKey)) \
-                .query(self.get_query_match('userIdentity.sessionContext.sessionIssuer.arn', dest_role_iam['Arn']))
-
-            event_names.update(self.get_events_from_search(innerquery))
-
-        return event_names
+        # Roles that are continuously assumed by automation can have millions of role assumptions.
+        # It may be better to just look at the final role in those cases.
+        return self.get_events_from_sessions(searchquery, sessionquery, dest_role_iam)
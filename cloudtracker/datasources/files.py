@@ -0,0 +1,287 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+"""
+
+import concurrent.futures
+import datetime
+import gzip
+import json
+import logging
+import os
+
+from cloudtracker import normalize_api_call
+from cloudtracker.cache import merge_rollups_into
+
+
+def iter_days(start, end):
+    """Yield each day from start to end, such as 2018-01-21, as a date"""
+    day = datetime.datetime.strptime(start, '%Y-%m-%d').date()
+    end = datetime.datetime.strptime(end, '%Y-%m-%d').date()
+    while day <= end:
+        yield day
+        day += datetime.timedelta(days=1)
+
+
+def iter_log_files(log_path, start, end):
+    """
+    Yield the paths of the CloudTrail log files of every region for the days from start to end,
+    given the path of an account's logs laid out as <region>/<yyyy>/<mm>/<dd>/*.json.gz
+    """
+    if not os.path.isdir(log_path):
+        return
+
+    for region in sorted(os.listdir(log_path)):
+        for day in iter_days(start, end):
+            directory = os.path.join(log_path, region, '{:04}'.format(day.year), '{:02}'.format(day.month),
+                                     '{:02}'.format(day.day))
+            if not os.path.isdir(directory):
+                continue
+            for file_name in sorted(os.listdir(directory)):
+                if file_name.endswith('.json.gz'):
+                    yield os.path.join(directory, file_name)
+
+
+def iter_records(paths):
+    """Yield the CloudTrail records of each gzipped log file, one file at a time"""
+    for path in paths:
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                records = json.load(f).get('Records') or []
+        except (OSError, EOFError, ValueError) as e:
+            # Truncated or corrupt files shouldn't stop the rest of the logs from being read
+            logging.warning('Skipping {}, which is not a readable CloudTrail log file: {}'.format(path, e))
+            continue
+        for record in records:
+            yield record
+
+
+def iter_successful_records(records, start, end):
+    """Yield the records from start to end, such as 2018-01-21, that weren't errors"""
+    for record in records:
+        if record.get('errorCode'):
+            continue
+        if not start <= record.get('eventTime', '')[:10] <= end:
+            continue
+        yield record
+
+
+class Summary(object):
+    """
+    Everything the file datasource needs to know about a set of CloudTrail records,
+    reduced as they are read so that the records themselves aren't kept.
+    """
+    users = None
+    roles = None
+    rollups = None
+    role_assumptions = None
+    session_events = None
+
+    def __init__(self):
+        # Names of the users and roles that performed actions
+        self.users = set()
+        self.roles = set()
+        # (principal ARN, action) -> [first seen, last seen, count]
+        self.rollups = {}
+        # Set of (caller ARN, caller's session issuer ARN, assumed role ARN, session access key id)
+        self.role_assumptions = set()
+        # (access key id, session issuer ARN) -> set of actions
+        self.session_events = {}
+
+    def add_record(self, record):
+        """Reduce a CloudTrail record into the summary"""
+        identity = record.get('userIdentity') or {}
+        session_issuer = (identity.get('sessionContext') or {}).get('sessionIssuer') or {}
+        action = normalize_api_call(record['eventSource'].split('.', 1)[0], record['eventName'])
+        event_time = record['eventTime']
+
+        if identity.get('userName'):
+            self.users.add(identity['userName'])
+        if session_issuer.get('userName'):
+            self.roles.add(session_issuer['userName'])
+
+        principal = session_issuer.get('arn') or identity.get('arn')
+        if principal:
+            merge_rollups_into(self.rollups, [(principal, action, event_time, event_time, 1)])
+
+        if session_issuer.get('arn') and identity.get('accessKeyId'):
+            self.session_events.setdefault((identity['accessKeyId'], session_issuer['arn']), set()).add(action)
+
+        if record['eventName'] == 'AssumeRole':
+            role_arn = (record.get('requestParameters') or {}).get('roleArn')
+            credentials = (record.get('responseElements') or {}).get('credentials') or {}
+            if role_arn and credentials.get('accessKeyId'):
+                self.role_assumptions.add((identity.get('arn'), session_issuer.get('arn'), role_arn,
+                                           credentials['accessKeyId']))
+
+    def merge(self, other):
+        """Merge another summary into this one"""
+        self.users.update(other.users)
+        self.roles.update(other.roles)
+        merge_rollups_into(self.rollups, (
+            (principal, action, first_seen, last_seen, count)
+            for (principal, action), (first_seen, last_seen, count) in other.rollups.items()))
+        self.role_assumptions.update(other.role_assumptions)
+        for key, actions in other.session_events.items():
+            self.session_events.setdefault(key, set()).update(actions)
+
+
+def summarize_files(paths, start, end):
+    """Read the given log files and reduce the successful records from start to end into a Summary"""
+    summary = Summary()
+    for record in iter_successful_records(iter_records(paths), start, end):
+        summary.add_record(record)
+    return summary
+
+
+# Each worker is given several shards, so that a slow shard doesn't hold up the others
+SHARDS_PER_WORKER = 4
+
+
+def summarize_files_in_parallel(paths, start, end, workers):
+    """
+    Shard the log files across a pool of processes, have each reduce its shard to a Summary,
+    and merge the partial summaries. Decompressing and parsing the files is CPU bound.
+    """
+    num_shards = min(len(paths), workers * SHARDS_PER_WORKER)
+    shards = [paths[i::num_shards] for i in range(num_shards)]
+
+    summary = Summary()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(summarize_files, shard, start, end) for shard in shards]
+        for count, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            summary.merge(future.result())
+            logging.debug('Read {} of {} shards of log files'.format(count, num_shards))
+    return summary
+
+
+class LocalFiles(object):
+    """
+    Datasource that reads CloudTrail log files from a local directory, laid out as they are in S3:
+    <path>/AWSLogs/<account id>/CloudTrail/<region>/<yyyy>/<mm>/<dd>/*.json.gz
+    Only the directories of the days in the date range are read.
+    """
+    path = None
+    log_path = None
+    workers = None
+    start = None
+    end = None
+    summary = None
+
+    def __init__(self, config, account, start, end):
+        self.path = os.path.expanduser(config['path'])
+        self.log_path = os.path.join(self.path, 'AWSLogs', str(account['id']), 'CloudTrail')
+        logging.info('Source of CloudTrail logs: {}'.format(self.log_path))
+        self.workers = config.get('workers') or os.cpu_count() or 1
+        if not os.path.isdir(self.log_path):
+            exit('ERROR: No CloudTrail logs found at {}'.format(self.log_path))
+        self.set_date_range(start, end)
+
+    def set_date_range(self, start, end):
+        """Restrict the searches that follow to the dates from start to end, such as 2018-01-21"""
+        self.start = start
+        self.end = end
+        self.summary = None
+
+    def get_cache_name(self):
+        """Identifies the data this datasource reads, for caching its results"""
+        return 'files:{}'.format(self.path)
+
+    def get_summary(self):
+        """Read the log files of the date range, once"""
+        if self.summary is None:
+            paths = list(iter_log_files(self.log_path, self.start, self.end))
+            logging.info('Reading {} CloudTrail log files from {} to {}'.format(len(paths), self.start, self.end))
+            if self.workers > 1 and len(paths) > 1:
+                self.summary = summarize_files_in_parallel(paths, self.start, self.end, self.workers)
+            else:
+                self.summary = summarize_files(paths, self.start, self.end)
+        return self.summary
+
+    def get_search_query(self):
+        # The file datasource doesn't use this call, but needs to support it being called
+        return None
+
+    def get_performed_users(self):
+        """
+        Returns the users that performed actions within the search filters
+        """
+        user_names = {}
+        for user_name in self.get_summary().users:
+            if user_name == 'HIDDEN_DUE_TO_SECURITY_REASONS':
+                # This happens when a user logs in with the wrong username
+                continue
+            user_names[user_name] = True
+        return user_names
+
+    def get_performed_roles(self):
+        """
+        Returns the roles that performed actions within the search filters
+        """
+        return {role_name: True for role_name in self.get_summary().roles}
+
+    def get_performed_event_names_by_principals(self, _):
+        """Return all performed events of every user and role, as a dict of the principal's ARN to its events"""
+        principals = {}
+        for principal, action in self.get_summary().rollups:
+            principals.setdefault(principal, {})[action] = True
+        return principals
+
+    def get_action_rollups(self, _):
+        """
+        Return when and how often every user and role performed each event, as a list of
+        (principal ARN, event, first seen, last seen, count)
+        """
+        return [(principal, action, first_seen, last_seen, count)
+                for (principal, action), (first_seen, last_seen, count) in self.get_summary().rollups.items()]
+
+    def get_performed_event_names_by_user(self, _, user_iam):
+        """For a user, return all performed events"""
+        return {action: True for principal, action in self.get_summary().rollups if principal == user_iam['Arn']}
+
+    def get_performed_event_names_by_role(self, _, role_iam):
+        """For a role, return all performed events"""
+        return {action: True for principal, action in self.get_summary().rollups if principal == role_iam['Arn']}
+
+    def get_events_of_sessions(self, role_assumptions, role_iam):
+        """Return the events performed with the sessions issued by the given role assumptions"""
+        summary = self.get_summary()
+        event_names = {}
+        for _, _, _, access_key_id in role_assumptions:
+            for action in summary.session_events.get((access_key_id, role_iam['Arn']), ()):
+                event_names[action] = True
+        return event_names
+
+    def get_performed_event_names_by_user_in_role(self, _, user_iam, role_iam):
+        """For a user that has assumed into another role, return all performed events"""
+        role_assumptions = [
+            role_assumption for role_assumption in self.get_summary().role_assumptions
+            if role_assumption[0] == user_iam['Arn'] and role_assumption[2] == role_iam['Arn']]
+        return self.get_events_of_sessions(role_assumptions, role_iam)
+
+    def get_performed_event_names_by_role_in_role(self, _, role_iam, dest_role_iam):
+        """For a role that has assumed into another role, return all performed events"""
+        role_assumptions = [
+            role_assumption for role_assumption in self.get_summary().role_assumptions
+            if role_assumption[1] == role_iam['Arn'] and role_assumption[2] == dest_role_iam['Arn']]
+        return self.get_events_of_sessions(role_assumptions, dest_role_iam)
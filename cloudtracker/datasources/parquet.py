@@ -0,0 +1,291 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+"""
+
+import concurrent.futures
+import datetime
+import logging
+import os
+import shutil
+
+from dateutil.relativedelta import relativedelta
+import pyarrow
+import pyarrow.compute as pc
+import pyarrow.dataset
+import pyarrow.parquet
+
+from cloudtracker import normalize_api_call
+from cloudtracker.cache import is_closed, merge_rollups, month_windows
+from cloudtracker.datasources.files import SHARDS_PER_WORKER, iter_log_files, iter_records
+
+# Only the fields CloudTracker uses are kept, with strings dictionary encoded
+SCHEMA = pyarrow.schema([
+    ('eventtime', pyarrow.string()),
+    ('eventsource', pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+    ('eventname', pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+    ('errorcode', pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+    ('user_type', pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+    ('user_arn', pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+    ('user_name', pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+    ('access_key_id', pyarrow.string()),
+    ('session_issuer_arn', pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+    ('session_issuer_user_name', pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+    ('request_role_arn', pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+    ('response_access_key_id', pyarrow.string()),
+])
+
+# Number of events held in memory before they are written out as a row group
+ROWS_PER_BATCH = 100000
+
+# Marks a month whose logs are complete, so it is never rewritten
+COMPLETE_MARKER = '_COMPLETE'
+
+
+def get_event_row(record):
+    """Extract the columns of the event cache from a CloudTrail record"""
+    identity = record.get('userIdentity') or {}
+    session_issuer = (identity.get('sessionContext') or {}).get('sessionIssuer') or {}
+
+    request_role_arn = None
+    response_access_key_id = None
+    if record.get('eventName') == 'AssumeRole':
+        request_role_arn = (record.get('requestParameters') or {}).get('roleArn')
+        credentials = (record.get('responseElements') or {}).get('credentials') or {}
+        response_access_key_id = credentials.get('accessKeyId')
+
+    return (
+        record.get('eventTime'),
+        record.get('eventSource'),
+        record.get('eventName'),
+        record.get('errorCode'),
+        identity.get('type'),
+        identity.get('arn'),
+        identity.get('userName'),
+        identity.get('accessKeyId'),
+        session_issuer.get('arn'),
+        session_issuer.get('userName'),
+        request_role_arn,
+        response_access_key_id,
+    )
+
+
+def write_batch(writer, rows):
+    """Write rows of event columns as a row group"""
+    columns = [pyarrow.array(column, type=pyarrow.string()) for column in zip(*rows)]
+    writer.write_table(pyarrow.Table.from_arrays(columns, names=SCHEMA.names).cast(SCHEMA))
+
+
+def write_event_file(paths, output_path):
+    """Write the records of the given CloudTrail log files to a Parquet file, returning the number of events"""
+    count = 0
+    rows = []
+    with pyarrow.parquet.ParquetWriter(output_path, SCHEMA, compression='zstd') as writer:
+        for record in iter_records(paths):
+            rows.append(get_event_row(record))
+            if len(rows) == ROWS_PER_BATCH:
+                write_batch(writer, rows)
+                count += len(rows)
+                rows = []
+        if len(rows) > 0:
+            write_batch(writer, rows)
+            count += len(rows)
+    return count
+
+
+class ParquetEvents(object):
+    """
+    Datasource backed by a columnar cache of CloudTrail events, stored as Parquet files
+    partitioned by month under <event_cache>/<account id>/month=<yyyy-mm>/.  Months that are
+    missing are built from the local log files, and the months that are not yet complete
+    are rebuilt on each run.  Every lookup is a vectorized filter over the cached columns.
+    """
+    log_path = None
+    cache_path = None
+    workers = None
+    start = None
+    end = None
+    table = None
+
+    def __init__(self, config, account, start, end):
+        path = os.path.expanduser(config['path'])
+        self.log_path = os.path.join(path, 'AWSLogs', str(account['id']), 'CloudTrail')
+        self.cache_path = os.path.join(os.path.expanduser(config['event_cache']), str(account['id']))
+        self.workers = config.get('workers') or os.cpu_count() or 1
+        logging.info('Source of CloudTrail logs: {}'.format(self.log_path))
+        logging.info('Using event cache: {}'.format(self.cache_path))
+        self.set_date_range(start, end)
+
+    def set_date_range(self, start, end):
+        """Restrict the searches that follow to the dates from start to end, such as 2018-01-21"""
+        self.start = start
+        self.end = end
+        self.table = None
+
+    def get_cache_name(self):
+        """Identifies the data this datasource reads, for caching its results"""
+        return 'parquet:{}'.format(self.cache_path)
+
+    def get_month_path(self, month):
+        return os.path.join(self.cache_path, 'month={}'.format(month))
+
+    def get_months(self):
+        """Return the months of the date range, such as 2018-01, and the last day of each"""
+        months = []
+        for window_start, _ in month_windows(self.start, self.end):
+            first_day = datetime.datetime.strptime(window_start[:7] + '-01', '%Y-%m-%d').date()
+            last_day = first_day + relativedelta(months=1) - datetime.timedelta(days=1)
+            months.append((window_start[:7], last_day.isoformat()))
+        return months
+
+    def build_months(self):
+        """Build the months of the date range that are missing or not complete from the log files"""
+        jobs = []
+        for month, last_day in self.get_months():
+            month_path = self.get_month_path(month)
+            if os.path.exists(os.path.join(month_path, COMPLETE_MARKER)):
+                continue
+            if os.path.exists(month_path):
+                shutil.rmtree(month_path)
+            os.makedirs(month_path)
+
+            paths = list(iter_log_files(self.log_path, month + '-01', last_day))
+            num_shards = max(1, min(len(paths), self.workers * SHARDS_PER_WORKER))
+            for i in range(num_shards):
+                jobs.append((paths[i::num_shards], os.path.join(month_path, 'part-{}.parquet'.format(i))))
+            logging.info('Building event cache for {} from {} log files'.format(month, len(paths)))
+
+        if len(jobs) > 0:
+            if self.workers > 1 and len(jobs) > 1:
+                with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as executor:
+                    list(executor.map(write_event_file, *zip(*jobs)))
+            else:
+                for paths, output_path in jobs:
+                    write_event_file(paths, output_path)
+
+        for month, last_day in self.get_months():
+            if is_closed(last_day):
+                open(os.path.join(self.get_month_path(month), COMPLETE_MARKER), 'w').close()
+
+    def get_table(self):
+        """Load the successful events of the date range from the cache, building it if needed"""
+        if self.table is None:
+            self.build_months()
+            paths = []
+            for month, _ in self.get_months():
+                month_path = self.get_month_path(month)
+                paths.extend(os.path.join(month_path, file_name) for file_name in sorted(os.listdir(month_path))
+                             if file_name.endswith('.parquet'))
+            dataset = pyarrow.dataset.dataset(paths, format='parquet', schema=SCHEMA)
+
+            end = (datetime.datetime.strptime(self.end, '%Y-%m-%d') + datetime.timedelta(days=1)).date().isoformat()
+            event_filter = (pyarrow.dataset.field('errorcode').is_null() &
+                            (pyarrow.dataset.field('eventtime') >= self.start) &
+                            (pyarrow.dataset.field('eventtime') < end))
+            table = dataset.to_table(filter=event_filter).unify_dictionaries()
+
+            principal = pc.coalesce(table['session_issuer_arn'].cast(pyarrow.string()),
+                                    table['user_arn'].cast(pyarrow.string()))
+            self.table = table.append_column('principal', principal)
+        return self.table
+
+    def get_event_names(self, table):
+        """Return the distinct events of a table of events"""
+        event_names = {}
+        for row in table.group_by(['eventsource', 'eventname']).aggregate([]).to_pylist():
+            event_names[normalize_api_call(row['eventsource'].split('.', 1)[0], row['eventname'])] = True
+        return event_names
+
+    def get_search_query(self):
+        # The event cache doesn't use this call, but needs to support it being called
+        return None
+
+    def get_performed_users(self):
+        """
+        Returns the users that performed actions within the search filters
+        """
+        user_names = pc.unique(self.get_table()['user_name'].cast(pyarrow.string())).drop_null()
+        # HIDDEN_DUE_TO_SECURITY_REASONS happens when a user logs in with the wrong username
+        return {user_name: True for user_name in user_names.to_pylist()
+                if user_name != 'HIDDEN_DUE_TO_SECURITY_REASONS'}
+
+    def get_performed_roles(self):
+        """
+        Returns the roles that performed actions within the search filters
+        """
+        role_names = pc.unique(self.get_table()['session_issuer_user_name'].cast(pyarrow.string())).drop_null()
+        return {role_name: True for role_name in role_names.to_pylist()}
+
+    def get_performed_event_names_by_user(self, _, user_iam):
+        """For a user, return all performed events"""
+        table = self.get_table()
+        return self.get_event_names(table.filter(pc.equal(table['principal'], user_iam['Arn'])))
+
+    def get_performed_event_names_by_role(self, _, role_iam):
+        """For a role, return all performed events"""
+        table = self.get_table()
+        return self.get_event_names(table.filter(pc.equal(table['principal'], role_iam['Arn'])))
+
+    def get_performed_event_names_by_principals(self, _):
+        """Return all performed events of every user and role, as a dict of the principal's ARN to its events"""
+        principals = {}
+        for principal, action, _, _, _ in self.get_action_rollups(None):
+            principals.setdefault(principal, {})[action] = True
+        return principals
+
+    def get_action_rollups(self, _):
+        """
+        Return when and how often every user and role performed each event, as a list of
+        (principal ARN, event, first seen, last seen, count)
+        """
+        table = self.get_table()
+        table = table.filter(pc.is_valid(table['principal']))
+        grouped = table.group_by(['principal', 'eventsource', 'eventname']).aggregate(
+            [('eventtime', 'min'), ('eventtime', 'max'), ('eventtime', 'count')])
+
+        return merge_rollups(
+            (row['principal'], normalize_api_call(row['eventsource'].split('.', 1)[0], row['eventname']),
+             row['eventtime_min'], row['eventtime_max'], row['eventtime_count'])
+            for row in grouped.to_pylist())
+
+    def get_events_of_sessions(self, role_assumptions, role_iam):
+        """Return the events performed with the sessions issued by the given AssumeRole events"""
+        table = self.get_table()
+        access_key_ids = pc.unique(role_assumptions['response_access_key_id']).drop_null()
+        sessions = table.filter(pc.and_(pc.is_in(table['access_key_id'], value_set=access_key_ids),
+                                        pc.equal(table['principal'], role_iam['Arn'])))
+        return self.get_event_names(sessions)
+
+    def get_performed_event_names_by_user_in_role(self, _, user_iam, role_iam):
+        """For a user that has assumed into another role, return all performed events"""
+        table = self.get_table()
+        role_assumptions = table.filter(pc.and_(pc.equal(table['user_arn'], user_iam['Arn']),
+                                                pc.equal(table['request_role_arn'], role_iam['Arn'])))
+        return self.get_events_of_sessions(role_assumptions, role_iam)
+
+    def get_performed_event_names_by_role_in_role(self, _, role_iam, dest_role_iam):
+        """For a role that has assumed into another role, return all performed events"""
+        table = self.get_table()
+        role_assumptions = table.filter(pc.and_(pc.equal(table['session_issuer_arn'], role_iam['Arn']),
+                                                pc.equal(table['request_role_arn'], dest_role_iam['Arn'])))
+        return self.get_events_of_sessions(role_assumptions, dest_role_iam)
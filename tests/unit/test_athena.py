@@ -0,0 +1,366 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+"""
+
+import datetime
+import os
+import tempfile
+import time
+import unittest
+from io import BytesIO
+from unittest.mock import MagicMock, patch
+
+import boto3
+from botocore.exceptions import ClientError
+from dateutil.relativedelta import relativedelta
+
+from cloudtracker.cache import is_closed
+from cloudtracker.datasources.athena import Athena, QueryIndex, QueryPoller
+
+
+class TestAthena(unittest.TestCase):
+    """Test the Athena datasource without connecting to AWS"""
+
+    def get_athena(self, rows):
+        """Return an Athena datasource whose queries all return the given rows"""
+        athena = Athena.__new__(Athena)
+        athena.table_name = 'cloudtrail_logs_111111111111'
+        athena.search_filter = '(errorcode IS NULL)'
+        athena.query_athena = MagicMock(return_value=rows)
+        athena.stream_query = MagicMock(side_effect=lambda query: iter(rows))
+        return athena
+
+    def test_get_events_from_search(self):
+        """Test rows of eventsource and eventname columns are decoded"""
+        athena = self.get_athena([])
+        self.assertEqual(athena.get_events_from_search([['s3.amazonaws.com', 'GetBucketAcl'],
+                                                        ['lambda.amazonaws.com', 'ListTags20170331']]),
+                         {'s3:getbucketacl': True, 'lambda:listtags': True})
+
+    def test_get_performed_event_names_by_principals(self):
+        """Test events are grouped by user ARN, or by the ARN of the role that issued the session"""
+        user_arn = 'arn:aws:iam::111111111111:user/alice'
+        role_arn = 'arn:aws:iam::111111111111:role/admin'
+        athena = self.get_athena([
+            ['s3.amazonaws.com', 'GetBucketAcl', user_arn, ''],
+            ['monitoring.amazonaws.com', 'DescribeAlarms', user_arn, ''],
+            ['iam.amazonaws.com', 'CreateUser', '', role_arn],
+            ['s3.amazonaws.com', 'GetBucketAcl', '', role_arn],
+        ])
+
+        self.assertEqual(athena.get_performed_event_names_by_principals(None), {
+            user_arn: {'s3:getbucketacl': True, 'cloudwatch:describealarms': True},
+            role_arn: {'iam:createuser': True, 's3:getbucketacl': True},
+        })
+        self.assertEqual(athena.stream_query.call_count, 1)
+
+    def test_get_action_rollups(self):
+        """Test rollups of events that normalize to the same action are merged"""
+        user_arn = 'arn:aws:iam::111111111111:user/alice'
+        athena = self.get_athena([
+            ['lambda.amazonaws.com', 'ListTags20170331', user_arn, '',
+             '2018-01-02T00:00:00Z', '2018-01-03T00:00:00Z', '2'],
+            ['lambda.amazonaws.com', 'ListTags20150331', user_arn, '',
+             '2018-01-01T00:00:00Z', '2018-01-02T00:00:00Z', '1'],
+        ])
+        self.assertEqual(athena.get_action_rollups(None),
+                         [(user_arn, 'lambda:listtags', '2018-01-01T00:00:00Z', '2018-01-03T00:00:00Z', 3)])
+
+    def test_run_queries(self):
+        """Test queries are run with a bounded number in flight, and results yielded as they complete"""
+        athena = Athena.__new__(Athena)
+        athena.output_bucket = 's3://results'
+        athena.max_concurrent_queries = 2
+        athena.athena = MagicMock()
+
+        started = []
+        polls = []
+
+        def start_query_execution(**kwargs):
+            started.append(kwargs['QueryString'])
+            return {'QueryExecutionId': kwargs['QueryString']}
+
+        def batch_get_query_execution(QueryExecutionIds):
+            polls.append(list(QueryExecutionIds))
+            # Each query succeeds the second time it is polled
+            return {'QueryExecutions': [
+                {'QueryExecutionId': query_id,
+                 'Status': {'State': 'SUCCEEDED' if sum(query_id in poll for poll in polls) > 1 else 'RUNNING'}}
+                for query_id in QueryExecutionIds]}
+
+        athena.athena.start_query_execution.side_effect = start_query_execution
+        athena.athena.batch_get_query_execution.side_effect = batch_get_query_execution
+        athena.get_query_results = MagicMock(side_effect=lambda query_id, skip_header: [[query_id]])
+
+        with patch('time.sleep'):
+            results = list(athena.run_queries(['q1', 'q2', 'q3']))
+
+        self.assertEqual(sorted(results), [('q1', [['q1']]), ('q2', [['q2']]), ('q3', [['q3']])])
+        self.assertEqual(started, ['q1', 'q2', 'q3'])
+        self.assertTrue(all(len(poll) <= 2 for poll in polls))
+
+    def test_run_queries_backoff(self):
+        """Test polling only speeds up again when new queries are started, not as queries complete"""
+        athena = Athena.__new__(Athena)
+        athena.output_bucket = 's3://results'
+        athena.athena = MagicMock()
+        athena.poll_initial_interval = 0.1
+        athena.poll_max_interval = 10
+        athena.poll_backoff = 2
+        athena.athena.start_query_execution.side_effect = lambda **kwargs: {'QueryExecutionId': kwargs['QueryString']}
+        athena.get_query_results = MagicMock(return_value=[])
+
+        # q1 succeeds on the second poll, and q2 on the fourth
+        polls = {'q1': 0, 'q2': 0}
+        def batch_get_query_execution(QueryExecutionIds):
+            for query_id in QueryExecutionIds:
+                polls[query_id] += 1
+            return {'QueryExecutions': [
+                {'QueryExecutionId': query_id,
+                 'Status': {'State': 'SUCCEEDED' if polls[query_id] >= int(query_id[1]) * 2 else 'RUNNING'}}
+                for query_id in QueryExecutionIds]}
+        athena.athena.batch_get_query_execution.side_effect = batch_get_query_execution
+
+        with patch('time.sleep') as sleep, patch('random.uniform', side_effect=lambda low, high: high):
+            list(athena.run_queries(['q1', 'q2']))
+        self.assertEqual([call[0][0] for call in sleep.call_args_list], [0.1, 0.2, 0.4])
+
+    def test_query_poller(self):
+        """Test polling backs off exponentially up to a cap, and waits longer for long running queries"""
+        with patch('random.uniform', side_effect=lambda low, high: high):
+            poller = QueryPoller(initial_interval=0.1, max_interval=1, backoff=2)
+            self.assertEqual([poller.next_delay() for _ in range(6)], [0.1, 0.2, 0.4, 0.8, 1, 1])
+
+            poller = QueryPoller(initial_interval=0.1, max_interval=10, backoff=2)
+            query_executions = [{'Statistics': {'TotalExecutionTimeInMillis': 20000}},
+                                {'Statistics': {'TotalExecutionTimeInMillis': 30000}}]
+            self.assertEqual(poller.next_delay(query_executions), 4.0)
+            self.assertEqual(poller.next_delay([{'Statistics': {}}]), 0.2)
+
+    def test_iter_s3_results(self):
+        """Test results of SELECT queries are streamed from the CSV file Athena writes to S3"""
+        athena = Athena.__new__(Athena)
+        athena.results_from_s3 = True
+        athena.athena = MagicMock()
+        athena.s3 = MagicMock()
+        athena.athena.get_query_execution.return_value = {'QueryExecution': {
+            'StatementType': 'DML',
+            'ResultConfiguration': {'OutputLocation': 's3://results/path/query-id.csv'}}}
+        athena.s3.get_object.return_value = {
+            'Body': BytesIO(b'"eventsource","eventname"\n"s3.amazonaws.com","GetBucketAcl"\n"a, b",\n')}
+
+        rows = athena.iter_query_results('query-id')
+        self.assertEqual(next(rows), ['s3.amazonaws.com', 'GetBucketAcl'])
+        self.assertEqual(list(rows), [['a, b', '']])
+        athena.s3.get_object.assert_called_once_with(Bucket='results', Key='path/query-id.csv')
+        athena.athena.get_paginator.assert_not_called()
+
+    def test_setup_compaction(self):
+        """Test only closed months that are not yet compacted are compacted, and the view excludes them"""
+        # On the first of the month, logs may still be delivered for the last day of the previous month
+        today = datetime.date.today().replace(day=1)
+        two_months_ago = today - relativedelta(months=2)
+        compacted = 'year={}/month={:0>2}'.format(two_months_ago.year, two_months_ago.month)
+        athena = self.get_athena([])
+        athena.raw_table_name = athena.table_name
+        athena.table_name = 'cloudtrail_view_111111111111'
+        athena.output_bucket = 's3://results'
+        athena.s3 = MagicMock()
+        athena.s3.get_paginator.return_value.paginate.return_value = [{'Contents': [{'Key': 'leftover'}]}]
+        athena.query_athena = MagicMock(
+            side_effect=lambda query, skip_header=True: [[compacted]] if query.startswith('SHOW') else [])
+        athena.run_queries = MagicMock(side_effect=lambda queries: ((query, []) for query in list(queries)))
+
+        with patch('cloudtracker.datasources.athena.is_closed', side_effect=lambda end: is_closed(end, today)):
+            athena.setup_compaction({}, {'id': '111111111111'})
+
+        drops, compactions = [list(call[0][0]) for call in athena.run_queries.call_args_list]
+        self.assertEqual(len(compactions), 9)
+        self.assertTrue(all(query.startswith('DROP TABLE IF EXISTS cloudtrail_compact_111111111111_20')
+                            for query in drops))
+        self.assertEqual(len(drops), 9)
+        self.assertEqual(athena.s3.delete_objects.call_count, 9)
+        athena.s3.delete_objects.assert_called_with(Bucket='results', Delete={'Objects': [{'Key': 'leftover'}]})
+        self.assertFalse(any(compacted in query for query in compactions))
+        last_month = today - relativedelta(months=1)
+        self.assertFalse(any('year={}/month={:0>2}'.format(last_month.year, last_month.month) in query
+                             for query in compactions))
+        self.assertTrue(all("external_location = 's3://results/cloudtracker-compact/111111111111/year=" in query
+                            for query in compactions))
+
+        view = athena.query_athena.call_args[0][0]
+        self.assertIn('CREATE OR REPLACE VIEW cloudtrail_view_111111111111', view)
+        self.assertIn("'{}{:0>2}'".format(two_months_ago.year, two_months_ago.month), view)
+        self.assertEqual(view.count("'20"), 10)
+        self.assertIn('principal_arn, year, month FROM cloudtrail_compact_111111111111', view)
+        self.assertIn('useridentity.arn) as principal_arn, year, month FROM cloudtrail_logs_111111111111', view)
+
+    def test_principal_filter(self):
+        """Test queries of the compacted table are restricted by principal, so its buckets are pruned"""
+        athena = self.get_athena([])
+        user_iam = {'Arn': 'arn:aws:iam::111111111111:user/alice'}
+        athena.get_performed_event_names_by_user(None, user_iam)
+        self.assertNotIn('principal_arn', athena.stream_query.call_args[0][0])
+
+        athena.compact = True
+        athena.get_performed_event_names_by_user(None, user_iam)
+        self.assertIn("where principal_arn = 'arn:aws:iam::111111111111:user/alice' and",
+                      athena.stream_query.call_args[0][0])
+
+    def test_get_table_properties(self):
+        """Test partition projection properties are only set when partition projection is used"""
+        athena = self.get_athena([])
+        self.assertEqual(athena.get_table_properties('s3://logs/AWSLogs/111111111111/CloudTrail'), '')
+
+        athena.partition_projection = True
+        with patch('boto3.session.Session') as session:
+            session.return_value.get_available_regions.return_value = ['us-east-1', 'us-west-2']
+            properties = athena.get_table_properties('s3://logs/AWSLogs/111111111111/CloudTrail')
+        self.assertTrue(properties.startswith('TBLPROPERTIES ('))
+        self.assertIn("'projection.enabled'='true'", properties)
+        self.assertIn("'projection.region.values'='us-east-1,us-west-2'", properties)
+        self.assertIn("'storage.location.template'="
+                      "'s3://logs/AWSLogs/111111111111/CloudTrail/${region}/${year}/${month}/${day}/'",
+                      properties)
+
+    def test_get_regions(self):
+        """Test regions are found from the prefixes in S3, remembered, and can be set in the config"""
+        config = {'s3_bucket': 'logs', 'path': ''}
+        # Account ids are read from the config as ints
+        account = {'id': 111111111111}
+        athena = self.get_athena([])
+        athena.s3 = MagicMock()
+        athena.s3.get_paginator.return_value.paginate.return_value = [
+            {'CommonPrefixes': [{'Prefix': 'AWSLogs/111111111111/CloudTrail/us-west-2/'},
+                                {'Prefix': 'AWSLogs/111111111111/CloudTrail/us-east-1/'}]}]
+
+        with tempfile.TemporaryDirectory() as directory:
+            athena.cache_directory = directory
+            self.assertEqual(athena.get_regions(config, account), ['us-east-1', 'us-west-2'])
+            self.assertEqual(athena.get_regions(config, account), ['us-east-1', 'us-west-2'])
+            self.assertTrue(os.path.exists(os.path.join(directory, 'regions.json')))
+        athena.s3.get_paginator.return_value.paginate.assert_called_once_with(
+            Bucket='logs', Prefix='AWSLogs/111111111111/CloudTrail/', Delimiter='/')
+
+        config['regions'] = ['eu-west-1']
+        self.assertEqual(athena.get_regions(config, account), ['eu-west-1'])
+
+    def test_set_date_range(self):
+        """Test queries are restricted to the months of the date range, and the regions with logs"""
+        athena = self.get_athena([])
+        athena.set_date_range('2017-11-15', '2019-01-02')
+        self.assertEqual(athena.search_filter.count('year ='), 15)
+        self.assertNotIn('region', athena.search_filter)
+
+        athena.regions = ['us-east-1', 'us-west-2']
+        athena.set_date_range('2018-01-01', '2018-02-01')
+        self.assertEqual(athena.search_filter,
+                         "(((year = '2018' and month = '01') or (year = '2018' and month = '02'))"
+                         " and eventtime >= '2018-01-01' and eventtime < '2018-02-02'"
+                         " and region IN ('us-east-1', 'us-west-2') and errorcode IS NULL)")
+
+    def test_set_date_range_by_day(self):
+        """Test months that are only partly in the date range are pruned to their days, with day partitions"""
+        athena = self.get_athena([])
+        athena.day_partitions = True
+        athena.set_date_range('2018-01-30', '2018-03-02')
+        self.assertEqual(athena.search_filter,
+                         "(((year = '2018' and month = '01' and day BETWEEN '30' AND '31')"
+                         " or (year = '2018' and month = '02')"
+                         " or (year = '2018' and month = '03' and day BETWEEN '01' AND '02'))"
+                         " and eventtime >= '2018-01-30' and eventtime < '2018-03-03' and errorcode IS NULL)")
+
+    def test_reuse_results(self):
+        """Test the results of a query that ran recently are reused, and Athena is asked to reuse them too"""
+        with tempfile.TemporaryDirectory() as directory:
+            athena = Athena.__new__(Athena)
+            athena.output_bucket = 's3://results'
+            athena.result_reuse_minutes = 60
+            athena.query_index = QueryIndex(60, directory)
+            athena.athena = MagicMock()
+            athena.athena.meta = boto3.client('athena', region_name='us-east-1').meta
+            athena.athena.start_query_execution.return_value = {'QueryExecutionId': 'query-id'}
+            athena.athena.get_query_execution.return_value = {'QueryExecution': {
+                'Status': {'State': 'SUCCEEDED'},
+                'ResultConfiguration': {'OutputLocation': 's3://results/query-id.csv'}}}
+            athena.s3 = MagicMock()
+            athena.wait_for_query_to_complete = MagicMock()
+            athena.iter_query_results = MagicMock(side_effect=lambda query_id, skip_header: iter([[query_id]]))
+
+            self.assertEqual(list(athena.stream_query('select 1')), [['query-id']])
+            self.assertEqual(list(athena.stream_query('select 1')), [['query-id']])
+            self.assertEqual(athena.athena.start_query_execution.call_count, 1)
+            self.assertEqual(
+                athena.athena.start_query_execution.call_args[1]['ResultReuseConfiguration'],
+                {'ResultReuseByAgeConfiguration': {'Enabled': True, 'MaxAgeInMinutes': 60}})
+            athena.s3.head_object.assert_called_once_with(Bucket='results', Key='query-id.csv')
+
+            list(athena.stream_query('select 2'))
+            self.assertEqual(athena.athena.start_query_execution.call_count, 2)
+
+            # Results older than the maximum age are not reused
+            with patch('time.time', return_value=time.time() + 61 * 60):
+                list(athena.stream_query('select 1'))
+            self.assertEqual(athena.athena.start_query_execution.call_count, 3)
+
+            # Nor are results that have been deleted from S3
+            athena.s3.head_object.side_effect = ClientError(
+                {'Error': {'Code': '404', 'Message': 'Not Found'}}, 'HeadObject')
+            self.assertEqual(list(athena.stream_query('select 1')), [['query-id']])
+            self.assertEqual(athena.athena.start_query_execution.call_count, 4)
+
+            # Versions of botocore without result reuse aren't sent the parameter
+            with patch.object(Athena, 'supports_result_reuse', return_value=False):
+                list(athena.stream_query('select 3'))
+            self.assertNotIn('ResultReuseConfiguration', athena.athena.start_query_execution.call_args[1])
+
+    def test_get_performed_event_names_by_user_in_role(self):
+        """Test role assumptions are joined to the events of their sessions, in the role's account"""
+        config = {'s3_bucket': 'logs', 'path': '', 'regions': ['us-east-1']}
+        # Account ids are read from the config as ints
+        account = {'id': 111111111111}
+        today = datetime.date.today().isoformat()
+        with patch('boto3.client'), patch('boto3.session.Session'):
+            athena = Athena(config, account, today, today, MagicMock(skip_setup=True))
+        athena.stream_query = MagicMock(side_effect=lambda query: iter([['s3.amazonaws.com', 'CreateBucket']]))
+        user_iam = {'Arn': 'arn:aws:iam::111111111111:user/alice'}
+
+        event_names = athena.get_performed_event_names_by_user_in_role(
+            None, user_iam, {'Arn': 'arn:aws:iam::111111111111:role/admin'})
+        self.assertEqual(event_names, {'s3:createbucket': True})
+        query = athena.stream_query.call_args[0][0]
+        self.assertIn("userIdentity.arn = 'arn:aws:iam::111111111111:user/alice'", query)
+        self.assertIn("json_extract_scalar(requestparameters, '$.roleArn') = 'arn:aws:iam::111111111111:role/admin'",
+                      query)
+        self.assertNotIn('cloudtrail_logs_222222222222', query)
+        # The role is in the same account, so its events are restricted to the account's regions too
+        self.assertEqual(query.count("region IN ('us-east-1')"), 2)
+
+        athena.get_performed_event_names_by_user_in_role(
+            None, user_iam, {'Arn': 'arn:aws:iam::222222222222:role/backup'})
+        query = athena.stream_query.call_args[0][0]
+        self.assertIn('from cloudtrail_logs_222222222222', query)
+        self.assertEqual(query.count("region IN ('us-east-1')"), 1)
+        self.assertIn('and {}'.format(athena.date_filter), query)
+        self.assertEqual(athena.stream_query.call_count, 2)
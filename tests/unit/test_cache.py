@@ -0,0 +1,182 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+"""
+
+import datetime
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from cloudtracker.cache import CachedDatasource, ResultCache, RollupStore, is_closed, is_whole_month, month_windows
+
+
+class FakeDatasource(object):
+    """Datasource that records the date ranges it was queried for"""
+    start = None
+    end = None
+
+    def __init__(self):
+        self.queries = []
+
+    def set_date_range(self, start, end):
+        self.start = start
+        self.end = end
+
+    def get_cache_name(self):
+        return 'fake'
+
+    def get_search_query(self):
+        return None
+
+    def get_performed_users(self):
+        self.queries.append((self.start, self.end))
+        return {'alice-{}'.format(self.start[:7]): True}
+
+
+class FakeRollupDatasource(FakeDatasource):
+    """Datasource that returns rollups"""
+
+    def get_action_rollups(self, _):
+        self.queries.append((self.start, self.end))
+        month = self.start[:7]
+        return [
+            ('arn:aws:iam::111111111111:user/alice', 's3:getobject',
+             month + '-10T00:00:00Z', month + '-20T00:00:00Z', 3),
+            ('arn:aws:iam::111111111111:role/admin', 'iam:createuser',
+             month + '-11T00:00:00Z', month + '-11T00:00:00Z', 1),
+        ]
+
+
+class TestCache(unittest.TestCase):
+    """Test the cache of datasource results"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_month_windows(self):
+        """Test date ranges are split into months"""
+        self.assertEqual(month_windows('2017-11-15', '2018-02-10'), [
+            ('2017-11-15', '2017-11-30'),
+            ('2017-12-01', '2017-12-31'),
+            ('2018-01-01', '2018-01-31'),
+            ('2018-02-01', '2018-02-10')])
+        self.assertEqual(month_windows('2018-01-05', '2018-01-05'), [('2018-01-05', '2018-01-05')])
+
+    def test_is_closed(self):
+        """Test only windows that can't receive more logs are closed"""
+        today = datetime.date(2018, 3, 10)
+        self.assertTrue(is_closed('2018-02-28', today))
+        self.assertTrue(is_closed('2018-03-08', today))
+        self.assertFalse(is_closed('2018-03-09', today))
+        self.assertFalse(is_closed('2018-03-31', today))
+
+    def test_is_whole_month(self):
+        """Test only windows that cover all of their month are whole"""
+        self.assertTrue(is_whole_month('2018-02-01', '2018-02-28'))
+        self.assertTrue(is_whole_month('2016-02-01', '2016-02-29'))
+        self.assertFalse(is_whole_month('2018-02-02', '2018-02-28'))
+        self.assertFalse(is_whole_month('2018-03-01', '2018-03-30'))
+
+    def test_cached_datasource(self):
+        """Test closed whole months are only fetched once, and other months are always fetched"""
+        start = '2017-12-15'
+        end = '2018-02-10'
+        account = {'id': 111111111111}
+
+        with patch('cloudtracker.cache.is_closed', side_effect=lambda window_end: window_end < '2018-02-01'):
+            datasource = FakeDatasource()
+            cached = CachedDatasource(datasource, ResultCache(self.directory), account, start, end)
+            users = cached.get_performed_users()
+            self.assertEqual(users, {'alice-2017-12': True, 'alice-2018-01': True, 'alice-2018-02': True})
+            self.assertEqual(datasource.queries, [
+                ('2017-12-15', '2017-12-31'), ('2018-01-01', '2018-01-31'), ('2018-02-01', '2018-02-10')])
+            # The date range is restored afterwards
+            self.assertEqual((datasource.start, datasource.end), (start, end))
+
+            # A later start, as the default start moves every day, still finds the whole months
+            datasource = FakeDatasource()
+            cached = CachedDatasource(datasource, ResultCache(self.directory), account, '2017-12-16', end)
+            self.assertEqual(cached.get_performed_users(), users)
+            self.assertEqual(datasource.queries, [('2017-12-16', '2017-12-31'), ('2018-02-01', '2018-02-10')])
+
+            # Only the whole month was stored
+            rows = ResultCache(self.directory).connection.execute('SELECT start, end FROM results').fetchall()
+            self.assertEqual(rows, [('2018-01-01', '2018-01-31')])
+
+        # Other calls are passed through to the datasource
+        self.assertEqual(cached.get_cache_name(), 'fake')
+
+    def test_concurrent_windows(self):
+        """Test datasources that run queries concurrently fetch months at once, in copies of themselves"""
+        datasource = FakeDatasource()
+        datasource.max_concurrent_queries = 4
+        account = {'id': 111111111111}
+
+        with patch('cloudtracker.cache.is_closed', return_value=True):
+            cached = CachedDatasource(datasource, ResultCache(self.directory), account, '2018-01-01', '2018-06-30')
+            self.assertEqual(cached.get_performed_users(), {
+                'alice-2018-{:0>2}'.format(month): True for month in range(1, 7)})
+            self.assertEqual(sorted(datasource.queries), month_windows('2018-01-01', '2018-06-30'))
+            # The datasource itself is left alone
+            self.assertEqual((datasource.start, datasource.end), (None, None))
+
+    def test_rollups(self):
+        """Test events are answered from rollups, and only uncovered months are fetched"""
+        account = {'id': 111111111111}
+        alice = {'Arn': 'arn:aws:iam::111111111111:user/alice'}
+        admin = {'Arn': 'arn:aws:iam::111111111111:role/admin'}
+
+        with patch('cloudtracker.cache.is_closed', side_effect=lambda window_end: window_end < '2018-03-01'):
+            datasource = FakeRollupDatasource()
+            cache = ResultCache(self.directory)
+            cached = CachedDatasource(datasource, cache, account, '2018-01-01', '2018-02-28', RollupStore(cache))
+            self.assertEqual(cached.get_performed_event_names_by_user(None, alice), {'s3:getobject': True})
+            self.assertEqual(len(datasource.queries), 2)
+
+            # A longer window only fetches the months that aren't covered
+            datasource = FakeRollupDatasource()
+            cache = ResultCache(self.directory)
+            cached = CachedDatasource(datasource, cache, account, '2018-01-01', '2018-03-05', RollupStore(cache))
+            self.assertEqual(cached.get_performed_event_names_by_role(None, admin), {'iam:createuser': True})
+            self.assertEqual(cached.get_performed_event_names_by_principals(None), {
+                alice['Arn']: {'s3:getobject': True},
+                admin['Arn']: {'iam:createuser': True}})
+            self.assertEqual(datasource.queries, [('2018-03-01', '2018-03-05'), ('2018-03-01', '2018-03-05')])
+
+            rollups = cached.get_action_rollups(alice['Arn'])
+            self.assertEqual(rollups, [
+                (alice['Arn'], 's3:getobject', '2018-01-10T00:00:00Z', '2018-03-20T00:00:00Z', 9)])
+
+            # Partial months are fetched each time, but never stored
+            for start in ('2017-12-15', '2017-12-16'):
+                datasource = FakeRollupDatasource()
+                cached = CachedDatasource(datasource, cache, account, start, '2018-02-28', RollupStore(cache))
+                self.assertEqual(cached.get_performed_event_names_by_user(None, alice), {'s3:getobject': True})
+                self.assertEqual(datasource.queries, [(start, '2017-12-31')])
+            rows = cache.connection.execute('SELECT DISTINCT start, end FROM rollups ORDER BY start').fetchall()
+            self.assertEqual(rows, [('2018-01-01', '2018-01-31'), ('2018-02-01', '2018-02-28')])
@@ -23,20 +23,47 @@ USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 ---------------------------------------------------------------------------
 """
 
+import argparse
 import sys
 import unittest
 from unittest.mock import patch
 from io import StringIO
 from contextlib import contextmanager
 
-from cloudtracker import (get_role_allowed_actions,
+from cloudtracker import (AccountIAM,
+                          ActionIndex,
+                          get_role_allowed_actions,
                           get_role_iam,
+                          get_user_allowed_actions,
                           make_list,
                           normalize_api_call,
+                          PolicyCache,
                           print_actor_diff,
                           print_diff,
                           Privileges,
-                          read_aws_api_list)
+                          read_aws_api_list,
+                          run)
+
+
+class StubDatasource(object):
+    """Datasource that answers from a dict of principal ARN to performed events"""
+    def __init__(self, performed):
+        self.performed = performed
+
+    def get_search_query(self):
+        return None
+
+    def get_performed_event_names_by_user(self, _, user_iam):
+        return self.performed.get(user_iam['Arn'], {})
+
+    def get_performed_event_names_by_role(self, _, role_iam):
+        return self.performed.get(role_iam['Arn'], {})
+
+
+class StubBulkDatasource(StubDatasource):
+    """Datasource that can also return the events of every principal at once"""
+    def get_performed_event_names_by_principals(self, _):
+        return self.performed
 
 
 @contextmanager
@@ -84,6 +111,21 @@ class TestCloudtracker(unittest.TestCase):
                            's3:getobjecttorrent': True,
                            's3:putobjecttagging': True})
 
+    def test_action_index(self):
+        """Test ActionIndex expands globs the same way across services"""
+        action_index = ActionIndex(self.aws_api_list)
+
+        self.assertEquals(action_index.expand('s3:PutObjectACL'), ['s3:putobjectacl'])
+        self.assertEquals(action_index.expand('s3:NotAnAction'), [])
+        self.assertEquals(action_index.expand('notaservice:*'), [])
+        self.assertEquals(action_index.expand('s3:PutObject?cl'), ['s3:putobjectacl'])
+        self.assertEquals(len(action_index.expand('*')), len(self.aws_api_list))
+        # CloudTrail names are converted to IAM names
+        self.assertTrue('s3:listallmybuckets' in action_index.expand('s3:List*'))
+        self.assertTrue('s3:listbuckets' not in action_index.expand('s3:List*'))
+        # Globs in the service name check every action
+        self.assertEquals(sorted(action_index.expand('s*:putobjectacl')), ['s3:putobjectacl'])
+
     def test_policy(self):
         """Test having multiple statements, some allowed, some denied"""
         privileges = Privileges(self.aws_api_list)
@@ -316,3 +358,144 @@ class TestCloudtracker(unittest.TestCase):
         aws_api_list = read_aws_api_list()
         self.assertEquals(sorted(['s3:putobject', 'kms:describekey', 'kms:decrypt', 's3:putobjectacl']),
                           sorted(get_role_allowed_actions(aws_api_list, self.role_iam, account_iam)))
+
+
+    def test_policy_cache(self):
+        """Test that a policy shared by several actors is only expanded once"""
+        account_iam = {
+            "RoleDetailList": [self.role_iam],
+            "UserDetailList": [],
+            "GroupDetailList": [],
+            "Policies": []
+        }
+        policy_cache = PolicyCache(max_size=2)
+
+        with patch.object(Privileges, 'get_actions_from_statement',
+                          autospec=True, side_effect=Privileges.get_actions_from_statement) as expand:
+            first = get_role_allowed_actions(self.aws_api_list, self.role_iam, account_iam, policy_cache)
+            self.assertEquals(len(policy_cache.policies), 2)
+            expand.reset_mock()
+            second = get_role_allowed_actions(self.aws_api_list, self.role_iam, account_iam, policy_cache)
+            self.assertEquals(expand.call_count, 0)
+        self.assertEquals(sorted(first), sorted(second))
+
+        # Least recently used policies are evicted
+        policy_cache.put(('inline', 'other'), (frozenset(), frozenset()))
+        self.assertEquals(len(policy_cache.policies), 2)
+        self.assertTrue(('inline', 'other') in policy_cache.policies)
+
+        policy_document = self.role_iam['RolePolicyList'][0]['PolicyDocument']
+        self.assertEquals(PolicyCache.get_key(policy_document), PolicyCache.get_key(dict(policy_document)))
+        self.assertEquals(PolicyCache.get_key(policy_document, 'arn:aws:iam::aws:policy/ReadOnlyAccess', 'v5'),
+                          ('managed', 'arn:aws:iam::aws:policy/ReadOnlyAccess', 'v5'))
+
+
+    def test_account_iam(self):
+        """Test AccountIAM indexes actors and resolves default policy versions"""
+        policy_arn = "arn:aws:iam::111111111111:policy/s3-read"
+        user_iam = {
+            "UserName": "alice",
+            "Arn": "arn:aws:iam::111111111111:user/alice",
+            "GroupList": ["readers"],
+            "AttachedManagedPolicies": [],
+            "UserPolicyList": [
+                {
+                    "PolicyName": "Kms",
+                    "PolicyDocument": {"Statement": [{"Action": "kms:Decrypt", "Resource": "*", "Effect": "Allow"}]}
+                }
+            ]
+        }
+        account_iam = AccountIAM({
+            "RoleDetailList": [self.role_iam],
+            "UserDetailList": [user_iam],
+            "GroupDetailList": [
+                {
+                    "GroupName": "readers",
+                    "AttachedManagedPolicies": [{"PolicyName": "s3-read", "PolicyArn": policy_arn}],
+                    "GroupPolicyList": []
+                }
+            ],
+            "Policies": [
+                {
+                    "Arn": policy_arn,
+                    "PolicyVersionList": [
+                        {"VersionId": "v1", "IsDefaultVersion": False,
+                         "Document": {"Statement": {"Action": "s3:*", "Resource": "*", "Effect": "Allow"}}},
+                        {"VersionId": "v2", "IsDefaultVersion": True,
+                         "Document": {"Statement": {"Action": "s3:GetObject", "Resource": "*", "Effect": "Allow"}}}
+                    ]
+                }
+            ]
+        })
+
+        self.assertEquals(account_iam.users['alice'], user_iam)
+        self.assertEquals(account_iam.roles['test_role'], self.role_iam)
+        self.assertEquals(account_iam.policies[policy_arn]['VersionId'], 'v2')
+        self.assertEquals(sorted(get_user_allowed_actions(self.aws_api_list, user_iam, account_iam)),
+                          ['kms:decrypt', 's3:getobject'])
+
+    def run_batch(self, datasource, **kwargs):
+        """Run cloudtracker in a batch mode against a stub datasource, and return its output"""
+        args = dict(account='demo', list=None, user=None, role=None, all_users=False, all_roles=False,
+                    destrole=None, destaccount=None, show_used=True, show_benign=True, show_unknown=True,
+                    use_color=False, use_cache=False)
+        args.update(kwargs)
+        config = {
+            'files': {'path': 'logs'},
+            'accounts': [{'name': 'demo', 'id': 111111111111, 'iam': 'demo_iam.json'}],
+        }
+        user_iam = {
+            "UserName": "alice",
+            "Arn": "arn:aws:iam::111111111111:user/alice",
+            "CreateDate": "2017-09-02T18:02:14Z",
+            "GroupList": [],
+            "AttachedManagedPolicies": [],
+            "UserPolicyList": [
+                {
+                    "PolicyName": "S3",
+                    "PolicyDocument": {"Statement": [{"Action": "s3:CreateBucket", "Resource": "*", "Effect": "Allow"}]}
+                }
+            ]
+        }
+        account_iam = AccountIAM({
+            "RoleDetailList": [self.role_iam],
+            "UserDetailList": [user_iam],
+            "GroupDetailList": [],
+            "Policies": []
+        })
+
+        with patch('cloudtracker.datasources.files.LocalFiles', return_value=datasource), \
+                patch('cloudtracker.get_account_iam', return_value=account_iam):
+            with capture(run, argparse.Namespace(**args), config, '2018-01-01', '2018-02-01') as output:
+                return output
+
+    def test_run_all(self):
+        """Test --all prints the used privileges of every user and role"""
+        performed = {
+            'arn:aws:iam::111111111111:user/alice': {'s3:createbucket': True},
+            'arn:aws:iam::111111111111:role/test_role': {'s3:putobject': True},
+        }
+        expected = ('Getting info on alice, user created 2017-09-02T18:02:14Z\n'
+                    '  s3:createbucket\n'
+                    'Getting info for role test_role\n'
+                    '  s3:putobject\n')
+        self.assertEqual(self.run_batch(StubDatasource(performed), all_users=True, all_roles=True), expected)
+
+        datasource = StubBulkDatasource(performed)
+        with patch.object(datasource, 'get_performed_event_names_by_user') as by_user:
+            self.assertEqual(self.run_batch(datasource, all_users=True, all_roles=True), expected)
+        by_user.assert_not_called()
+
+    def test_run_all_users_and_roles(self):
+        """Test --all-users and --all-roles only audit their kind of actor"""
+        performed = {'arn:aws:iam::111111111111:user/alice': {'s3:createbucket': True}}
+        self.assertEqual(self.run_batch(StubDatasource(performed), all_users=True),
+                         'Getting info on alice, user created 2017-09-02T18:02:14Z\n  s3:createbucket\n')
+        self.assertEqual(self.run_batch(StubDatasource(performed), all_roles=True),
+                         'Getting info for role test_role\n')
+
+    def test_run_all_with_destrole(self):
+        """Test --destrole can not be used with the batch modes"""
+        with self.assertRaises(SystemExit) as context:
+            self.run_batch(StubDatasource({}), all_users=True, destrole='admin')
+        self.assertIn('--destrole', str(context.exception.code))
@@ -0,0 +1,220 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+"""
+
+import unittest
+from unittest.mock import MagicMock, patch
+
+try:
+    from elasticsearch_dsl import Q, Search
+    from elasticsearch_dsl.response import Response
+    from cloudtracker.datasources.es import ElasticSearch
+except ImportError:
+    ElasticSearch = None
+
+
+@unittest.skipIf(ElasticSearch is None, 'ElasticSearch support not installed')
+class TestElasticSearch(unittest.TestCase):
+    """Test the ElasticSearch datasource without connecting to a cluster"""
+
+    def get_es(self, es_version=6, es_minor_version=8):
+        es = ElasticSearch.__new__(ElasticSearch)
+        es.es = MagicMock()
+        es.index = 'cloudtrail'
+        es.key_prefix = ''
+        es.es_version = es_version
+        es.es_minor_version = es_minor_version
+        es.searchfilter = {}
+        return es
+
+    def execute_with(self, pages):
+        """Return a Search.execute replacement that answers each search with the next page of aggregations"""
+        searches = []
+        pages = iter(pages)
+
+        def execute(search):
+            searches.append(search.to_dict())
+            return Response(search, {'hits': {'hits': [], 'total': 0}, 'aggregations': next(pages)})
+        return execute, searches
+
+    def test_get_events_from_search(self):
+        """Test composite aggregations are paged through with the key of the last bucket"""
+        es = self.get_es()
+        pages = [
+            {'buckets': {'buckets': [
+                {'key': {'event_source': 's3.amazonaws.com', 'event_name': 'GetBucketAcl'}, 'doc_count': 1},
+                {'key': {'event_source': 's3.amazonaws.com', 'event_name': 'ListBuckets'}, 'doc_count': 1}]}},
+            {'buckets': {'buckets': [
+                {'key': {'event_source': 'lambda.amazonaws.com', 'event_name': 'ListTags20170331'}, 'doc_count': 1}]}},
+        ]
+        execute, searches = self.execute_with(pages)
+        with patch('cloudtracker.datasources.es.COMPOSITE_PAGE_SIZE', 2), patch.object(Search, 'execute', execute):
+            event_names = es.get_events_from_search(es.get_search_query())
+
+        self.assertEqual(event_names, {'s3:getbucketacl': True, 's3:listbuckets': True, 'lambda:listtags': True})
+        self.assertEqual(len(searches), 2)
+        self.assertNotIn('after', searches[0]['aggs']['buckets']['composite'])
+        self.assertEqual(searches[1]['aggs']['buckets']['composite']['after'],
+                         {'event_source': 's3.amazonaws.com', 'event_name': 'ListBuckets'})
+        self.assertEqual(searches[0]['size'], 0)
+
+    def test_get_performed_users_terms(self):
+        """Test versions without composite aggregations use terms aggregations"""
+        es = self.get_es(es_version=5)
+        pages = [{'user_name': {'buckets': [{'key': 'alice', 'doc_count': 1},
+                                            {'key': 'HIDDEN_DUE_TO_SECURITY_REASONS', 'doc_count': 1}]}}]
+        execute, searches = self.execute_with(pages)
+        with patch.object(Search, 'execute', execute):
+            self.assertEqual(es.get_performed_users(), {'alice': True})
+        self.assertEqual(searches[0]['aggs']['user_name']['terms']['field'], 'userIdentity.userName.keyword')
+
+    def test_get_events_from_search_terms(self):
+        """Test 6.0, which has no composite aggregations, uses nested terms aggregations"""
+        es = self.get_es(es_version=6, es_minor_version=0)
+        pages = [{'event_source': {'buckets': [
+            {'key': 's3.amazonaws.com', 'doc_count': 2, 'event_name': {'buckets': [
+                {'key': 'GetBucketAcl', 'doc_count': 1}, {'key': 'ListBuckets', 'doc_count': 1}]}},
+            {'key': 'lambda.amazonaws.com', 'doc_count': 1, 'event_name': {'buckets': [
+                {'key': 'ListTags20170331', 'doc_count': 1}]}}]}}]
+        execute, searches = self.execute_with(pages)
+        with patch.object(Search, 'execute', execute):
+            event_names = es.get_events_from_search(es.get_search_query())
+
+        self.assertEqual(event_names, {'s3:getbucketacl': True, 's3:listbuckets': True, 'lambda:listtags': True})
+        self.assertNotIn('buckets', searches[0]['aggs'])
+        self.assertEqual(searches[0]['aggs']['event_source']['aggs']['event_name']['terms']['field'],
+                         'eventName.keyword')
+
+    def test_get_performed_event_names_by_role_in_role(self):
+        """Test the events of role assumption sessions are searched for in chunks of session keys"""
+        es = self.get_es()
+        pages = [
+            {'buckets': {'buckets': [{'key': {'session_key': 'ASIA1'}, 'doc_count': 1},
+                                     {'key': {'session_key': 'ASIA2'}, 'doc_count': 1},
+                                     {'key': {'session_key': 'ASIA3'}, 'doc_count': 1}]}},
+            {'buckets': {'buckets': [
+                {'key': {'event_source': 's3.amazonaws.com', 'event_name': 'CreateBucket'}, 'doc_count': 2}]}},
+            {'buckets': {'buckets': [
+                {'key': {'event_source': 'iam.amazonaws.com', 'event_name': 'CreateUser'}, 'doc_count': 1}]}},
+        ]
+        execute, searches = self.execute_with(pages)
+        with patch('cloudtracker.datasources.es.SESSION_KEY_CHUNK_SIZE', 2), \
+                patch.object(Search, 'execute', execute), patch('builtins.print'):
+            event_names = es.get_performed_event_names_by_role_in_role(
+                es.get_search_query(),
+                {'Arn': 'arn:aws:iam::111111111111:role/automation'},
+                {'Arn': 'arn:aws:iam::111111111111:role/admin'})
+
+        self.assertEqual(event_names, {'s3:createbucket': True, 'iam:createuser': True})
+        self.assertEqual(len(searches), 3)
+        self.assertIn({'terms': {'userIdentity.accessKeyId.keyword': ['ASIA1', 'ASIA2']}},
+                      searches[1]['query']['bool']['must'])
+        self.assertIn({'terms': {'userIdentity.accessKeyId.keyword': ['ASIA3']}},
+                      searches[2]['query']['bool']['must'])
+
+    def test_get_performed_event_names_by_principals(self):
+        """Test events are bucketed by the ARN of the role that issued the session, or else of the user"""
+        user_arn = 'arn:aws:iam::111111111111:user/alice'
+        role_arn = 'arn:aws:iam::111111111111:role/admin'
+        es = self.get_es()
+        pages = [
+            {'buckets': {'buckets': [
+                {'key': {'principal': role_arn, 'event_source': 'iam.amazonaws.com', 'event_name': 'CreateUser'},
+                 'doc_count': 1}]}},
+            {'buckets': {'buckets': [
+                {'key': {'principal': user_arn, 'event_source': 's3.amazonaws.com', 'event_name': 'GetBucketAcl'},
+                 'doc_count': 3},
+                {'key': {'principal': user_arn, 'event_source': 'sts.amazonaws.com', 'event_name': 'AssumeRole'},
+                 'doc_count': 1}]}},
+        ]
+        execute, searches = self.execute_with(pages)
+        with patch.object(Search, 'execute', execute):
+            principals = es.get_performed_event_names_by_principals(es.get_search_query())
+
+        self.assertEqual(principals, {
+            role_arn: {'iam:createuser': True},
+            user_arn: {'s3:getbucketacl': True, 'sts:assumerole': True},
+        })
+        self.assertEqual(len(searches), 2)
+
+    def test_connection_settings(self):
+        """Test hosts, timeouts, retries and sniffing are passed from the config to the client"""
+        config = {
+            'hosts': [{'host': 'node1', 'port': 9200}, {'host': 'node2', 'port': 9200}],
+            'index': 'cloudtrail',
+            'timeout': 60,
+            'maxsize': 25,
+            'retry_on_timeout': True,
+            'sniff_on_start': True,
+        }
+        with patch('cloudtracker.datasources.es.Elasticsearch') as client:
+            client.return_value.info.return_value = {'version': {'number': '6.8.2'}}
+            ElasticSearch(config, '2018-01-01', '2018-02-01')
+        client.assert_called_once_with(config['hosts'], timeout=60, maxsize=25, retry_on_timeout=True,
+                                       sniff_on_start=True)
+
+        with patch('cloudtracker.datasources.es.Elasticsearch') as client:
+            client.return_value.info.return_value = {'version': {'number': '6.8.2'}}
+            ElasticSearch({'host': 'localhost', 'port': 9200}, '2018-01-01', '2018-02-01')
+        client.assert_called_once_with([{'host': 'localhost', 'port': 9200}], timeout=900)
+
+    def test_search_filters(self):
+        """Test the date and error filters are in filter context, rounded to days, and searches are cached"""
+        es = self.get_es()
+        es.timestamp_field = 'eventTime'
+        es.searchfilter['filter_errors'] = ~Q('exists', field='errorCode.keyword')
+        es.set_date_range('2018-01-01', '2018-02-01')
+        search = es.get_search_query()
+
+        self.assertNotIn('must', search.to_dict()['query']['bool'])
+        self.assertIn({'range': {'eventTime': {'gte': '2018-01-01||/d'}}}, search.to_dict()['query']['bool']['filter'])
+        self.assertIn({'range': {'eventTime': {'lte': '2018-02-01||/d'}}}, search.to_dict()['query']['bool']['filter'])
+
+        params = []
+        execute, searches = self.execute_with([{'user_name': {'buckets': []}, 'buckets': {'buckets': []}}])
+        with patch.object(Search, 'execute', lambda search: params.append(search._params) or execute(search)):
+            es.get_performed_users()
+        self.assertEqual(params, [{'request_cache': 'true'}])
+        self.assertEqual(searches[0]['size'], 0)
+
+    def test_get_performed_event_names_by_principals_terms(self):
+        """Test ElasticSearch 1 gets its exists queries as filters, and is warned of truncated buckets"""
+        user_arn = 'arn:aws:iam::111111111111:user/alice'
+        es = self.get_es(es_version=1, es_minor_version=7)
+        pages = [
+            {'principal': {'sum_other_doc_count': 0, 'buckets': []}},
+            {'principal': {'sum_other_doc_count': 5, 'buckets': [
+                {'key': user_arn, 'doc_count': 1, 'event_source': {'sum_other_doc_count': 0, 'buckets': [
+                    {'key': 's3.amazonaws.com', 'doc_count': 1, 'event_name': {'sum_other_doc_count': 0, 'buckets': [
+                        {'key': 'GetBucketAcl', 'doc_count': 1}]}}]}}]}},
+        ]
+        execute, searches = self.execute_with(pages)
+        with patch.object(Search, 'execute', execute), self.assertLogs(level='WARNING') as logs:
+            principals = es.get_performed_event_names_by_principals(es.get_search_query())
+
+        self.assertEqual(principals, {user_arn: {'s3:getbucketacl': True}})
+        self.assertEqual(len(logs.output), 1)
+        exists = {'exists': {'field': 'userIdentity.sessionContext.sessionIssuer.arn.raw'}}
+        self.assertEqual(searches[0]['query'], {'filtered': {'filter': exists}})
+        self.assertEqual(searches[1]['query'], {'bool': {'must_not': [{'filtered': {'filter': exists}}]}})
@@ -0,0 +1,181 @@
+"""
+Copyright 2018 Duo Security
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+following disclaimer in the documentation and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+---------------------------------------------------------------------------
+"""
+
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from cloudtracker.datasources.files import LocalFiles, iter_log_files, iter_records
+
+try:
+    from cloudtracker.datasources.parquet import ParquetEvents
+except ImportError:
+    ParquetEvents = None
+
+ACCOUNT = {'id': 111111111111}
+ALICE = {'Arn': 'arn:aws:iam::111111111111:user/alice'}
+ADMIN = {'Arn': 'arn:aws:iam::111111111111:role/admin'}
+
+
+def user_record(event_time, event_source, event_name, **kwargs):
+    """Return a CloudTrail record of alice performing an event"""
+    record = {
+        'eventTime': event_time,
+        'eventSource': event_source,
+        'eventName': event_name,
+        'userIdentity': {'type': 'IAMUser', 'arn': ALICE['Arn'], 'userName': 'alice', 'accessKeyId': 'AKIAALICE'}
+    }
+    record.update(kwargs)
+    return record
+
+
+def role_record(event_time, event_source, event_name, access_key_id='ASIASESSION'):
+    """Return a CloudTrail record of a session of the admin role performing an event"""
+    return {
+        'eventTime': event_time,
+        'eventSource': event_source,
+        'eventName': event_name,
+        'userIdentity': {
+            'type': 'AssumedRole',
+            'arn': 'arn:aws:sts::111111111111:assumed-role/admin/alice',
+            'accessKeyId': access_key_id,
+            'sessionContext': {'sessionIssuer': {'type': 'Role', 'arn': ADMIN['Arn'], 'userName': 'admin'}}
+        }
+    }
+
+
+class TestLocalFiles(unittest.TestCase):
+    """Test the datasource reading CloudTrail log files from a local directory"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.log_path = os.path.join(self.directory, 'AWSLogs', '111111111111', 'CloudTrail')
+
+        self.write_log('us-east-1', '2018/01/20', [
+            user_record('2018-01-20T10:00:00Z', 's3.amazonaws.com', 'ListBuckets')])
+        self.write_log('us-east-1', '2018/01/21', [
+            user_record('2018-01-21T10:00:00Z', 'sts.amazonaws.com', 'AssumeRole',
+                        requestParameters={'roleArn': ADMIN['Arn']},
+                        responseElements={'credentials': {'accessKeyId': 'ASIASESSION'}}),
+            user_record('2018-01-21T11:00:00Z', 'iam.amazonaws.com', 'CreateUser', errorCode='AccessDenied'),
+            role_record('2018-01-21T12:00:00Z', 'iam.amazonaws.com', 'CreateUser'),
+            role_record('2018-01-21T13:00:00Z', 'ec2.amazonaws.com', 'DescribeInstances', 'ASIAOTHER')])
+        self.write_log('us-west-2', '2018/01/22', [
+            role_record('2018-01-22T10:00:00Z', 'monitoring.amazonaws.com', 'DescribeAlarms')])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_log(self, region, day, records):
+        """Write a gzipped CloudTrail log file"""
+        directory = os.path.join(self.log_path, region, day)
+        os.makedirs(directory)
+        with gzip.open(os.path.join(directory, 'log.json.gz'), 'wt') as f:
+            json.dump({'Records': records}, f)
+
+    def test_iter_log_files(self):
+        """Test only the directories of the days in the date range are read"""
+        paths = list(iter_log_files(self.log_path, '2018-01-21', '2018-01-31'))
+        self.assertEqual(paths, [
+            os.path.join(self.log_path, 'us-east-1', '2018', '01', '21', 'log.json.gz'),
+            os.path.join(self.log_path, 'us-west-2', '2018', '01', '22', 'log.json.gz')])
+
+    def test_performed(self):
+        """Test the users, roles and events performed are found, without errors"""
+        datasource = LocalFiles({'path': self.directory, 'workers': 1}, ACCOUNT, '2018-01-01', '2018-01-31')
+
+        self.assertEqual(datasource.get_performed_users(), {'alice': True})
+        self.assertEqual(datasource.get_performed_roles(), {'admin': True})
+        self.assertEqual(datasource.get_performed_event_names_by_user(None, ALICE),
+                         {'s3:listbuckets': True, 'sts:assumerole': True})
+        self.assertEqual(datasource.get_performed_event_names_by_role(None, ADMIN),
+                         {'iam:createuser': True, 'ec2:describeinstances': True, 'cloudwatch:describealarms': True})
+        # Only the session alice assumed is included
+        self.assertEqual(datasource.get_performed_event_names_by_user_in_role(None, ALICE, ADMIN),
+                         {'iam:createuser': True, 'cloudwatch:describealarms': True})
+
+        datasource.set_date_range('2018-01-22', '2018-01-31')
+        self.assertEqual(datasource.get_performed_event_names_by_principals(None),
+                         {ADMIN['Arn']: {'cloudwatch:describealarms': True}})
+
+    def test_corrupt_files(self):
+        """Test truncated or corrupt log files are skipped, in the pool of processes too"""
+        directory = os.path.join(self.log_path, 'us-east-1', '2018', '01', '23')
+        os.makedirs(directory)
+        with open(os.path.join(self.log_path, 'us-east-1', '2018', '01', '20', 'log.json.gz'), 'rb') as f:
+            data = f.read()
+        with open(os.path.join(directory, 'truncated.json.gz'), 'wb') as f:
+            f.write(data[:len(data) // 2])
+        with open(os.path.join(directory, 'corrupt.json.gz'), 'wb') as f:
+            f.write(b'not gzip')
+        with gzip.open(os.path.join(directory, 'invalid.json.gz'), 'wt') as f:
+            f.write('{"Records": [')
+
+        with self.assertLogs(level='WARNING') as logs:
+            records = list(iter_records(sorted(iter_log_files(self.log_path, '2018-01-20', '2018-01-23'))))
+        self.assertEqual(len(logs.output), 3)
+        self.assertEqual(len(records), 6)
+
+        for workers in [1, 2]:
+            datasource = LocalFiles({'path': self.directory, 'workers': workers}, ACCOUNT, '2018-01-01', '2018-01-31')
+            self.assertEqual(datasource.get_performed_users(), {'alice': True})
+
+    def test_parallel(self):
+        """Test reading the files in a pool of processes gives the same results"""
+        serial = LocalFiles({'path': self.directory, 'workers': 1}, ACCOUNT, '2018-01-01', '2018-01-31')
+        parallel = LocalFiles({'path': self.directory, 'workers': 2}, ACCOUNT, '2018-01-01', '2018-01-31')
+
+        self.assertEqual(parallel.get_summary().rollups, serial.get_summary().rollups)
+        self.assertEqual(parallel.get_summary().role_assumptions, serial.get_summary().role_assumptions)
+        self.assertEqual(parallel.get_summary().session_events, serial.get_summary().session_events)
+        self.assertEqual(parallel.get_performed_users(), serial.get_performed_users())
+
+    @unittest.skipIf(ParquetEvents is None, 'pyarrow is not installed')
+    def test_parquet_events(self):
+        """Test the columnar event cache gives the same results as reading the files"""
+        config = {'path': self.directory, 'workers': 1, 'event_cache': os.path.join(self.directory, 'cache')}
+        files = LocalFiles(config, ACCOUNT, '2018-01-01', '2018-01-31')
+        parquet = ParquetEvents(config, ACCOUNT, '2018-01-01', '2018-01-31')
+
+        self.assertEqual(parquet.get_performed_users(), files.get_performed_users())
+        self.assertEqual(parquet.get_performed_roles(), files.get_performed_roles())
+        self.assertEqual(parquet.get_performed_event_names_by_user(None, ALICE),
+                         files.get_performed_event_names_by_user(None, ALICE))
+        self.assertEqual(parquet.get_performed_event_names_by_role(None, ADMIN),
+                         files.get_performed_event_names_by_role(None, ADMIN))
+        self.assertEqual(parquet.get_performed_event_names_by_user_in_role(None, ALICE, ADMIN),
+                         files.get_performed_event_names_by_user_in_role(None, ALICE, ADMIN))
+        self.assertEqual(sorted(parquet.get_action_rollups(None)), sorted(files.get_action_rollups(None)))
+        self.assertTrue(os.path.exists(os.path.join(self.directory, 'cache', '111111111111', 'month=2018-01',
+                                                    '_COMPLETE')))
+
+        # Completed months are read from the cache, without the log files
+        shutil.rmtree(os.path.join(self.directory, 'AWSLogs'))
+        parquet = ParquetEvents(config, ACCOUNT, '2018-01-22', '2018-01-31')
+        self.assertEqual(parquet.get_performed_event_names_by_principals(None),
+                         {ADMIN['Arn']: {'cloudwatch:describealarms': True}})